@@ -0,0 +1,463 @@
+"""
+Caching of filter choices, using Django's cache framework.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import six
+from django.conf import settings
+from django.db.models import signals
+try:
+    from django.db.models.sql.datastructures import EmptyResultSet
+except ImportError:
+    from django.core.exceptions import EmptyResultSet
+
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:  # Django < 1.7 fallback
+    from django.db.models import get_models
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:  # Django < 1.7 fallback
+    from django.core.cache import get_cache
+
+from .utils import filter_in_chunks
+from .utils import get_model_path
+
+
+# Models for which we already listen to signals.
+_watched_models = set()
+
+
+def model_key(model):
+    opts = model._meta
+    return 'easyfilters:model:%s.%s' % (opts.app_label, opts.object_name)
+
+
+def invalidate_model(sender, **kwargs):
+    """
+    Signal handler that makes all cached choices that depend on the sender
+    model stale, by changing its version number.
+    """
+    for alias in FilterChoicesCache.aliases:
+        cache = get_cache(alias)
+        key = model_key(sender)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Not there (or evicted) - any new version number will do.
+            cache.add(key, new_version())
+
+
+def new_version():
+    return int(time.time() * 1000)
+
+
+def watch_model(model, m2m=False):
+    if (model, m2m) in _watched_models:
+        return
+    _watched_models.add((model, m2m))
+    uid = 'easyfilters:%s' % model_key(model)
+    if m2m:
+        signals.m2m_changed.connect(invalidate_model, sender=model,
+                                    dispatch_uid=uid)
+    else:
+        signals.post_save.connect(invalidate_model, sender=model,
+                                  dispatch_uid=uid)
+        signals.post_delete.connect(invalidate_model, sender=model,
+                                    dispatch_uid=uid)
+
+
+def related_models(filter_):
+    """
+    Returns the models (and many-to-many intermediate models) whose changes
+    can alter the choices of the filter.
+    """
+    models = set(get_model_path(filter_.model, filter_.field))
+    through = set()
+    rel = filter_.field_obj.rel
+    if rel is not None:
+        models.add(filter_.rel_model)
+        if getattr(rel, 'through', None) is not None:
+            through.add(rel.through)
+    return models, through
+
+
+def queryset_tables(qs):
+    """
+    Returns the names of the tables that qs uses.
+    """
+    query = qs.query
+    tables = set()
+    for alias in query.tables:
+        join = query.alias_map.get(alias)
+        if join is None:
+            continue
+        # Django 1.4 uses plain tuples, with the table name first.
+        tables.add(getattr(join, 'table_name', None) or join[0])
+    tables.add(qs.model._meta.db_table)
+    return tables
+
+
+# {table name: models}, filled on first use.
+_table_models = {}
+
+
+def queryset_models(qs):
+    """
+    Returns the models (and many-to-many intermediate models) whose tables qs
+    uses, like related_models.
+    """
+    if not _table_models:
+        for model in get_models(include_auto_created=True):
+            _table_models.setdefault(model._meta.db_table, []).append(model)
+    models = set()
+    through = set()
+    for table in queryset_tables(qs):
+        for model in _table_models.get(table, ()):
+            if model._meta.auto_created:
+                through.add(model)
+            else:
+                models.add(model)
+    return models, through
+
+
+def queryset_fingerprint(qs):
+    try:
+        sql, params = qs.query.sql_with_params()
+    except EmptyResultSet:
+        sql, params = 'EMPTY', ()
+    return '%s:%s:%r' % (qs.db, sql, params)
+
+
+def canonical_params(params):
+    # Order of keys doesn't matter, but the order of values for a key does,
+    # since it is preserved in the links that are built.
+    return sorted((k, params.getlist(k)) for k in params.keys())
+
+
+class FilterChoicesCache(object):
+    """
+    Stores the result of Filter.get_choices in a Django cache.
+
+    Keys are built from the QuerySet SQL, the filter class and field, the
+    params (with keys in canonical order), and version numbers for all models
+    the filter depends on. Saving or deleting instances of those models, or
+    changing many-to-many relations, changes the version numbers, which makes
+    the cached choices stale.
+    """
+    # Cache aliases that are in use, so that signal handlers can update
+    # version numbers in all of them.
+    aliases = set()
+
+    def __init__(self, alias='default', timeout=300, namespace=''):
+        self.alias = alias
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+        self.namespace = namespace
+        FilterChoicesCache.aliases.add(alias)
+
+    def watch(self, filters):
+        """
+        Connects the signal handlers for all models that filters depend on.
+        """
+        for f in filters:
+            self.watch_models(*related_models(f))
+
+    def watch_models(self, models, through):
+        for model in models:
+            watch_model(model)
+        for model in through:
+            watch_model(model, m2m=True)
+
+    def dependencies(self, filter_, qs):
+        """
+        Returns the models and intermediate models whose changes can alter
+        the choices of filter_ for qs: those of the filter, and those whose
+        tables qs uses (e.g. for other filters).
+        """
+        models, through = related_models(filter_)
+        qs_models, qs_through = queryset_models(qs)
+        return models | qs_models, through | qs_through
+
+    def get_versions(self, filters, qs):
+        """
+        Returns a dictionary of the current version numbers for all models that
+        filters depend on.
+        """
+        keys = set()
+        for f in filters:
+            models, through = self.dependencies(f, qs)
+            self.watch_models(models, through)
+            keys.update(model_key(m) for m in models | through)
+        versions = self.cache.get_many(list(keys))
+        for key in keys:
+            if key not in versions:
+                self.cache.add(key, new_version())
+                versions[key] = self.cache.get(key)
+        return versions
+
+    def make_key(self, filter_, qs, versions=None):
+        if versions is None:
+            versions = self.get_versions([filter_], qs)
+        models, through = self.dependencies(filter_, qs)
+        parts = [self.namespace,
+                 type(filter_).__module__,
+                 type(filter_).__name__,
+                 filter_.field,
+                 filter_.query_param,
+                 queryset_fingerprint(qs),
+                 canonical_params(filter_.params),
+                 sorted((model_key(m), versions[model_key(m)])
+                        for m in models | through)]
+        digest = hashlib.md5(six.text_type(parts).encode('utf-8')).hexdigest()
+        return 'easyfilters:choices:%s' % digest
+
+    def get_choices(self, filter_, qs):
+        """
+        Returns filter_.get_choices(qs), from the cache if possible.
+        """
+        key = self.make_key(filter_, qs)
+        choices = self.cache.get(key)
+        if choices is None:
+            choices = filter_.get_choices(qs)
+            self.cache.set(key, choices, self.timeout)
+        return choices
+
+    def get_many_choices(self, filters, qs, compute):
+        """
+        Returns a dictionary of {filter: choices} for the filters, using a
+        single cache lookup. 'compute' is called with the list of filters that
+        were not in the cache, and must return a dictionary of {filter:
+        choices} for them.
+        """
+        versions = self.get_versions(filters, qs)
+        keys = dict((f, self.make_key(f, qs, versions)) for f in filters)
+        cached = self.cache.get_many(list(keys.values()))
+        result = dict((f, cached[key]) for f, key in keys.items()
+                      if key in cached)
+        missing = [f for f in filters if f not in result]
+        if missing:
+            computed = compute(missing)
+            self.cache.set_many(dict((keys[f], choices)
+                                     for f, choices in computed.items()),
+                                self.timeout)
+            result.update(computed)
+        return result
+
+
+class RelatedObjectCache(object):
+    """
+    A per-process LRU cache of model instances, keyed by model, field name and
+    field value. All entries for a model are dropped when an instance of it is
+    saved or deleted, and entries expire after 'timeout' seconds, so that
+    changes made without signals (e.g. by QuerySet.update()) are picked up.
+
+    If max_size is None, the EASYFILTERS_RELATED_CACHE_SIZE setting is used,
+    or 1000 if that is not set. If timeout is None, the
+    EASYFILTERS_RELATED_CACHE_TIMEOUT setting is used, or 300 if that is not
+    set.
+    """
+    def __init__(self, max_size=None, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.objects = OrderedDict()
+        self.watched = set()
+
+    def get_many(self, model, field_name, values):
+        found = {}
+        now = time.time()
+        with self.lock:
+            for value in values:
+                key = (model, field_name, value)
+                try:
+                    entry = self.objects.pop(key)
+                except KeyError:
+                    continue
+                expires, obj = entry
+                if expires <= now:
+                    continue
+                # Move to the end, as most recently used.
+                self.objects[key] = entry
+                found[value] = obj
+        return found
+
+    def set_many(self, model, field_name, objs):
+        self.watch(model)
+        timeout = self.timeout
+        if timeout is None:
+            timeout = getattr(settings, 'EASYFILTERS_RELATED_CACHE_TIMEOUT',
+                              300)
+        expires = time.time() + timeout
+        with self.lock:
+            for value, obj in objs.items():
+                self.objects.pop((model, field_name, value), None)
+                self.objects[model, field_name, value] = (expires, obj)
+            max_size = self.max_size
+            if max_size is None:
+                max_size = getattr(settings, 'EASYFILTERS_RELATED_CACHE_SIZE',
+                                   1000)
+            while len(self.objects) > max_size:
+                self.objects.popitem(last=False)
+
+    def invalidate(self, sender, **kwargs):
+        with self.lock:
+            for key in [k for k in self.objects if k[0] is sender]:
+                del self.objects[key]
+
+    def clear(self):
+        with self.lock:
+            self.objects.clear()
+
+    def watch(self, model):
+        if model in self.watched:
+            return
+        self.watched.add(model)
+        uid = 'easyfilters:related:%s:%s' % (id(self), model_key(model))
+        signals.post_save.connect(self.invalidate, sender=model,
+                                  dispatch_uid=uid)
+        signals.post_delete.connect(self.invalidate, sender=model,
+                                    dispatch_uid=uid)
+
+
+related_objects = RelatedObjectCache()
+
+
+class QuerySetCache(object):
+    """
+    A per-process LRU cache of results computed from QuerySets, keyed by the
+    QuerySet fingerprint and other options. Entries are dropped when instances
+    of any model whose table the QuerySet uses are saved or deleted, or when
+    its many-to-many relations change, and after 'timeout' seconds if it is
+    not None. Results longer than max_rows are not cached.
+
+    With keep_stale, entries are only marked as stale by changes, and get()
+    can still return them for a while.
+
+    The maximum number of entries is read from the setting named by
+    size_setting, or is default_size if that is not set.
+    """
+    def __init__(self, size_setting, default_size=100, max_rows=10000,
+                 timeout=None, keep_stale=False):
+        self.size_setting = size_setting
+        self.default_size = default_size
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.keep_stale = keep_stale
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.connected = False
+
+    def make_key(self, qs, *options):
+        return (queryset_fingerprint(qs),) + options
+
+    def get(self, key, max_staleness=0):
+        """
+        Returns the result for key, or None if there isn't one, or if it has
+        been stale for more than max_staleness seconds.
+        """
+        now = time.time()
+        with self.lock:
+            try:
+                entry = self.results.pop(key)
+            except KeyError:
+                return None
+            tables, expires, stale_since, result = entry
+            if expires is not None and expires < now:
+                return None
+            if stale_since is not None and stale_since + max_staleness < now:
+                return None
+            self.results[key] = entry
+            return result
+
+    def set(self, key, qs, result, rows=None):
+        """
+        Stores result for key. rows is the number of rows in result, if that
+        isn't len(result).
+        """
+        if rows is None:
+            rows = len(result)
+        if rows > self.max_rows:
+            return
+        self.connect()
+        tables = queryset_tables(qs)
+        expires = None
+        if self.timeout is not None:
+            expires = time.time() + self.timeout
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = [tables, expires, None, result]
+            max_size = getattr(settings, self.size_setting, self.default_size)
+            while len(self.results) > max_size:
+                self.results.popitem(last=False)
+
+    def invalidate(self, sender, **kwargs):
+        table = sender._meta.db_table
+        now = time.time()
+        with self.lock:
+            for key in [k for k, entry in self.results.items()
+                        if table in entry[0]]:
+                if not self.keep_stale:
+                    del self.results[key]
+                elif self.results[key][2] is None:
+                    self.results[key][2] = now
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def connect(self):
+        if self.connected:
+            return
+        self.connected = True
+        uid = 'easyfilters:querysets:%s' % id(self)
+        for signal in (signals.post_save, signals.post_delete,
+                       signals.m2m_changed):
+            signal.connect(self.invalidate, dispatch_uid=uid)
+
+
+# Date histograms of DateTimeFilter, when its cache_histogram option is used.
+date_histograms = QuerySetCache('EASYFILTERS_HISTOGRAM_CACHE_SIZE')
+
+# Boundaries of the quantile ranges of NumericRangeFilter. They are only
+# approximate anyway, so they are also kept when the data is changed without
+# signals, until they time out.
+range_boundaries = QuerySetCache('EASYFILTERS_RANGES_CACHE_SIZE',
+                                 timeout=300)
+
+# Fine-grained histograms of NumericRangeFilter, when its histogram_bins
+# option is used.
+numeric_histograms = QuerySetCache('EASYFILTERS_NUMERIC_HISTOGRAM_CACHE_SIZE')
+
+# Min/Max bounds of the range filters, when their cache_bounds option is used.
+# Changes that don't send signals are picked up within an hour.
+field_bounds = QuerySetCache('EASYFILTERS_BOUNDS_CACHE_SIZE', timeout=3600,
+                             keep_stale=True)
+
+
+def get_related_objects(model, field, values, use_cache=False):
+    """
+    Returns a dictionary of {value: instance} for the instances of model whose
+    'field' has one of the values, using a single query. With use_cache,
+    instances are taken from (and added to) the related_objects cache.
+    """
+    values = list(values)
+    found = {}
+    if use_cache:
+        found = related_objects.get_many(model, field.name, values)
+        values = [v for v in values if v not in found]
+    if values:
+        fetched = dict((getattr(obj, field.attname), obj)
+                       for obj in filter_in_chunks(model.objects.all(),
+                                                   field.name, values))
+        if use_cache:
+            related_objects.set_many(model, field.name, fetched)
+        found.update(fetched)
+    return found
@@ -3,7 +3,9 @@ from __future__ import unicode_literals
 import math
 import operator
 import re
+from collections import namedtuple
 from datetime import date
+from datetime import datetime
 from logging import getLogger
 
 import six
@@ -12,13 +14,41 @@ from django import VERSION
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.dates import MONTHS
-
+from django.utils.datastructures import SortedDict
+from django.utils.http import urlencode
+
+from .cache import date_histograms
+from .cache import field_bounds
+from .cache import get_related_objects
+from .cache import numeric_histograms
+from .cache import queryset_fingerprint
+from .cache import range_boundaries
+from .queries import can_sample
+from .queries import combined_counts
 from .queries import date_aggregation
+from .queries import date_aggregation_query
+from .queries import is_approximate
+from .queries import m2m_value_counts
+from .queries import m2m_value_counts_query
+from .queries import numeric_histogram
 from .queries import numeric_range_counts
+from .queries import numeric_range_counts_query
+from .queries import probe_values_and_bounds
+from .queries import quantile_bounds
+from .queries import sample_queryset
+from .queries import scale_counts
+from .queries import total_count
 from .queries import value_counts
+from .queries import value_counts_query
+from .queries import value_label_counts
 from .ranges import auto_ranges
+from .ranges import histogram_grid
+from .ranges import quantile_ranges
+from .utils import filter_in_chunks
 from .utils import get_model_field
+from .utils import in_chunk_size
 from .utils import python_2_unicode_compatible
+from .utils import run_in_executor
 
 logger = getLogger(__name__)
 
@@ -32,15 +62,124 @@ else:
     total_ordering = lambda c: c
 
 
-try:
-    from collections import namedtuple
-    FilterChoice = namedtuple('FilterChoice', 'label count params link_type')
-except ImportError:
-    # We don't use it as a tuple, so this will do:
-    class FilterChoice(object):
-        def __init__(self, label, count, params, link_type):
-            self.label, self.count, self.params, self.link_type = \
-                label, count, params, link_type
+FilterChoice = namedtuple('FilterChoice',
+                          'label count params link_type approximate')
+FilterChoice.__new__.__defaults__ = (False,)
+
+
+class SharedParams(object):
+    """
+    The params of a filter without its own parameters and 'page', which are
+    shared by the params of all its choices. The query string for them is
+    only encoded once.
+    """
+    def __init__(self, params, query_param):
+        self.params = params.copy()
+        for key in [query_param, query_param + '--isnull', 'page']:
+            self.params.pop(key, None)
+        self.query_param = query_param
+        self._query = None
+
+    @property
+    def query(self):
+        if self._query is None:
+            self._query = urlencode(self.params, doseq=True)
+        return self._query
+
+
+class ChoiceParams(object):
+    """
+    The params of a FilterChoice, as the SharedParams of the filter and the
+    values of its query_param. This has the read-only methods of a QueryDict,
+    which is only built when they are used, and urlencode() only encodes the
+    values of the filter.
+    """
+    __hash__ = None
+
+    def __init__(self, shared, param_values, isnull):
+        self.shared = shared
+        self.param_values = param_values
+        self.isnull = isnull
+        self._params = None
+
+    def get_params(self):
+        if self._params is None:
+            params = self.shared.params.copy()
+            query_param = self.shared.query_param
+            if self.isnull:
+                params[query_param + '--isnull'] = ''
+            if self.param_values:
+                params.setlist(query_param, list(self.param_values))
+            self._params = params
+        return self._params
+
+    def urlencode(self, safe=None):
+        if safe:
+            return self.get_params().urlencode(safe)
+        own = []
+        if self.isnull:
+            own.append((self.shared.query_param + '--isnull', ''))
+        if self.param_values:
+            own.append((self.shared.query_param, list(self.param_values)))
+        return '&'.join(q for q in [self.shared.query,
+                                    urlencode(own, doseq=True)] if q)
+
+    def copy(self):
+        return self.get_params().copy()
+
+    def dict(self):
+        return self.get_params().dict()
+
+    def get(self, key, default=None):
+        return self.get_params().get(key, default)
+
+    def getlist(self, key):
+        return self.get_params().getlist(key)
+
+    def keys(self):
+        return self.get_params().keys()
+
+    def values(self):
+        return self.get_params().values()
+
+    def items(self):
+        return self.get_params().items()
+
+    def lists(self):
+        return self.get_params().lists()
+
+    def __getitem__(self, key):
+        return self.get_params()[key]
+
+    def __contains__(self, key):
+        return key in self.get_params()
+
+    def __iter__(self):
+        return iter(self.get_params())
+
+    def __len__(self):
+        return len(self.get_params())
+
+    def __eq__(self, other):
+        if isinstance(other, ChoiceParams):
+            other = other.get_params()
+        return self.get_params() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<ChoiceParams: %r>' % self.get_params()
+
+
+class ChoiceList(list):
+    """
+    A list of FilterChoices. has_more is True when some choices were left out
+    because of the max_choices option.
+    """
+    def __init__(self, choices=(), has_more=False):
+        super(ChoiceList, self).__init__(choices)
+        self.has_more = has_more
 
 
 FILTER_ADD = 'add'
@@ -54,6 +193,12 @@ class Filter(object):
     and can apply the information from a URL to filter a QuerySet.
     """
 
+    # Results of get_count_queries, see set_prefetched_counts
+    _prefetched_counts = (None, {})
+
+    # See build_params
+    _shared_params = None
+
     # Public interface
 
     def __init__(self,
@@ -63,7 +208,12 @@ class Filter(object):
                  query_param=None,
                  order_by_count=False,
                  sticky=False,
-                 show_counts=True):
+                 show_counts=True,
+                 max_choices=None,
+                 cache_related=False,
+                 approximate=False,
+                 sample_every=100,
+                 approximate_threshold=100000):
         self.field = field
         self.model = model
         self.params = params
@@ -76,10 +226,15 @@ class Filter(object):
         if self.field_obj.rel is not None:
             self.rel_model = self.field_obj.rel.to
             self.rel_field = self.field_obj.rel.get_related_field()
+        self.cache_related = cache_related
         # Make chosen an immutable sequence, to stop accidental mutation.
         self.chosen = tuple(self.choices_from_params())
         self.sticky = sticky
         self.show_counts = show_counts
+        self.max_choices = max_choices
+        self.approximate = approximate
+        self.sample_every = sample_every
+        self.approximate_threshold = approximate_threshold
 
     def apply_filter(self, qs):
         """
@@ -101,6 +256,74 @@ class Filter(object):
         """
         raise NotImplementedError()
 
+    def aget_choices(self, qs):
+        """
+        Asynchronous version of get_choices, returning an asyncio Future. The
+        queries are run in the default executor of the event loop.
+        """
+        return run_in_executor(qs.db, self.get_choices, qs)
+
+    def get_count_queries(self, qs):
+        """
+        Returns a dictionary of {key: GroupedCounts} for the count queries that
+        get_choices(qs) is going to need and that can be planned before any
+        other query is run. FilterSet uses this to run the count queries of all
+        its filters as a single statement (see FilterSet.combine_queries).
+        """
+        return {}
+
+    def set_prefetched_counts(self, qs, counts):
+        """
+        Stores the results of the queries returned by get_count_queries(qs),
+        as a dictionary with the same keys.
+        """
+        self._prefetched_counts = (qs, counts)
+
+    def get_prefetched_counts(self, qs, key):
+        """
+        Returns the stored result for the count query 'key', or None if it
+        wasn't prefetched for this QuerySet.
+        """
+        prefetched_qs, counts = self._prefetched_counts
+        if prefetched_qs is not qs:
+            return None
+        return counts.get(key)
+
+    def get_counts(self, func, qs, *args):
+        """
+        Returns func(qs, *args), where func returns counts as a dictionary of
+        {value: count} or a list of (value, count) rows.
+
+        With the 'approximate' option, func is run on a sample of qs and the
+        counts are scaled up (see queries.is_approximate), unless the sample
+        shows that qs has less than approximate_threshold rows.
+        """
+        if self.approximate and can_sample(qs):
+            counts = func(sample_queryset(qs, self.sample_every), *args)
+            if (total_count(counts) * self.sample_every >=
+                    self.approximate_threshold):
+                return scale_counts(counts, self.sample_every)
+        return func(qs, *args)
+
+    def truncate_counts(self, count_dict):
+        """
+        Returns count_dict with only the first max_choices values (plus NULL),
+        and whether some values were left out. count_dict should have been
+        fetched with a limit of max_choices + 1.
+        """
+        if self.max_choices is None:
+            return count_dict, False
+        values = [val for val in count_dict if val is not None]
+        if len(values) <= self.max_choices:
+            return count_dict, False
+        count_dict = count_dict.copy()
+        for val in values[self.max_choices:]:
+            del count_dict[val]
+        return count_dict, True
+
+    def get_counts_limit(self):
+        return None if self.max_choices is None else self.max_choices + 1
+
     # Methods that are used by base implementation above
 
     def choices_from_params(self):
@@ -143,30 +366,50 @@ class Filter(object):
         """
         return list(map(self.param_from_choice, choices))
 
+    def get_related_choices(self, values_qs, count_dict, rel_field, has_more):
+        """
+        Returns the related objects whose rel_field is one of the keys of
+        count_dict (and maybe others, that should be skipped), ordered like the
+        related model. values_qs is a ValuesQuerySet of the values that were
+        counted, or None to look up the keys of count_dict.
+        """
+        rel_qs = self.rel_model.objects.all()
+        if not (values_qs is None or has_more or is_approximate(count_dict)):
+            # count_dict has all the values in values_qs, so a subquery can be
+            # used instead of a long list of values.
+            return rel_qs.filter(**{rel_field.name + '__in':
+                                    values_qs.order_by()})
+        values = [val for val in count_dict if val is not None]
+        objs = filter_in_chunks(rel_qs, rel_field.name, values)
+        chunk_size = in_chunk_size(rel_qs.db)
+        if chunk_size is not None and len(values) > chunk_size:
+            # Each chunk is ordered, but not the whole list, so use the order
+            # of count_dict instead.
+            positions = dict((val, i) for i, val in enumerate(count_dict))
+            objs.sort(key=lambda o: positions[getattr(o, rel_field.attname)])
+        return objs
+
     def build_params(self, add=Ellipsis, remove=()):
         """
-        Builds a new parameter MultiDict.
+        Builds the params for a link, as a ChoiceParams.
         add is an optional item to add,
         remove is an option list of items to remove.
         """
-        params = self.params.copy()
         chosen = list(self.chosen)
         for r in remove:
             chosen.remove(r)
         if add is not Ellipsis and add not in chosen:
             chosen.append(add)
-        if NullChoice in chosen:
-            params[self.query_param + "--isnull"] = ''
-        else:
-            params.pop(self.query_param + "--isnull", None)
+        isnull = NullChoice in chosen
         chosen = list(i for i in chosen if i is not NullChoice)
-        if chosen:
-            params.setlist(self.query_param,
-                           self.paramlist_from_choices(chosen))
-        else:
-            params.pop(self.query_param, None)
-        params.pop('page', None)  # links should reset paging
-        return params
+        if self._shared_params is None:
+            # The other params (without 'page', so that links reset paging)
+            # are the same for all choices.
+            self._shared_params = SharedParams(self.params, self.query_param)
+        return ChoiceParams(self._shared_params,
+                            self.paramlist_from_choices(chosen)
+                            if chosen else (),
+                            isnull)
 
     def sort_choices(self, qs, choices):
         """
@@ -218,7 +461,8 @@ class SingleValueMixin(object):
                 choices[i] = FilterChoice(label=choices[i].label,
                                           count=choices[i].count,
                                           link_type=FILTER_DISPLAY,
-                                          params=None)
+                                          params=None,
+                                          approximate=choices[i].approximate)
         return choices
 
 
@@ -251,7 +495,8 @@ class ChooseAgainMixin(SingleValueMixin):
         choices_remove = self.get_choices_remove(qs)
         choices_add = self.normalize_add_choices(self.get_choices_add(qs))
         choices_add = self.sort_choices(qs, choices_add)
-        return choices_remove + choices_add
+        return ChoiceList(choices_remove + choices_add,
+                          getattr(choices_add, 'has_more', False))
 
 
 class RelatedObjectMixin(object):
@@ -274,14 +519,29 @@ class SimpleQueryMixin(object):
         Returns a SortedDict dictionary of {value: count}.
 
         The order is the underlying order produced by sorting ascending on the
-        DB field.
+        DB field. With max_choices, at most max_choices + 1 values are
+        returned, see truncate_counts.
         """
+        limit = self.get_counts_limit()
         if self.show_counts or self.order_by_count:
-            return value_counts(qs, self.field)
+            count_dict = self.get_prefetched_counts(qs, 'values')
+            if count_dict is None:
+                count_dict = self.get_counts(value_counts, qs, self.field,
+                                             limit, self.order_by_count)
+            return count_dict
         else:
-            return dict((val, None)
-                        for val, in qs.values_list(self.field)
-                        .order_by(self.field).distinct())
+            values = qs.values_list(self.field).order_by(self.field).distinct()
+            if limit is not None:
+                values = values[:limit]
+            return SortedDict((val, None) for val, in values)
+
+    def get_count_queries(self, qs):
+        # Once something is chosen, only 'remove' choices are shown, and they
+        # don't need counts.
+        if (self.chosen or self.approximate or self.max_choices is not None
+                or not (self.show_counts or self.order_by_count)):
+            return {}
+        return {'values': value_counts_query(qs, self.field)}
 
 
 class RangeFilterMixin(ChooseAgainMixin):
@@ -291,6 +551,27 @@ class RangeFilterMixin(ChooseAgainMixin):
     # __cmp__ and __eq__ methods for sorting.
     choice_type = None
 
+    def __init__(self, *args, **kwargs):
+        # The number of seconds for which cached Min/Max bounds can still be
+        # used after the data changes, or None to not cache them.
+        self.cache_bounds = kwargs.pop('cache_bounds', None)
+        super(RangeFilterMixin, self).__init__(*args, **kwargs)
+
+    def get_cached_bounds(self, qs):
+        """
+        Returns the (lower, upper) bounds of the field in qs from the
+        field_bounds cache, or None.
+        """
+        if self.cache_bounds is None:
+            return None
+        return field_bounds.get(field_bounds.make_key(qs, self.field),
+                                self.cache_bounds)
+
+    def set_cached_bounds(self, qs, lower, upper):
+        if self.cache_bounds is not None:
+            field_bounds.set(field_bounds.make_key(qs, self.field), qs,
+                             (lower, upper))
+
     def choice_from_param(self, param):
         return self.choice_type.from_param(param)
 
@@ -335,13 +616,16 @@ class ValuesFilter(ChooseOnceMixin, SimpleQueryMixin, Filter):
         """
         Called by 'get_choices', this is usually the one to override.
         """
-        count_dict = self.get_values_counts(qs)
-        return [FilterChoice(self.render_choice_object(val),
-                             count,
-                             self.build_params(add=val),
-                             FILTER_ADD)
-                for val, count in count_dict.items()
-                for val in (NullChoice if val is None else val,)]
+        count_dict, has_more = self.truncate_counts(self.get_values_counts(qs))
+        approximate = is_approximate(count_dict)
+        return ChoiceList([FilterChoice(self.render_choice_object(val),
+                                        count,
+                                        self.build_params(add=val),
+                                        FILTER_ADD,
+                                        approximate)
+                           for val, count in count_dict.items()
+                           for val in (NullChoice if val is None else val,)],
+                          has_more)
 
 
 class ChoicesFilter(ValuesFilter):
@@ -352,17 +636,25 @@ class ChoicesFilter(ValuesFilter):
     # 1) ensure we only display options that are in 'choices'
     # 2) ensure the order is the same as in choices
     # 3) make display value = the second element in choices' tuples.
+    # Cache of choices_dict for each field
+    _choices_dicts = {}
+
     def __init__(self, *args, **kwargs):
         super(ChoicesFilter, self).__init__(*args, **kwargs)
-        self.choices_dict = dict(self.field_obj.flatchoices)
+        try:
+            self.choices_dict = self._choices_dicts[self.field_obj]
+        except KeyError:
+            self.choices_dict = dict(self.field_obj.flatchoices)
+            self._choices_dicts[self.field_obj] = self.choices_dict
 
     def render_choice_object(self, choice):
         # 3) above
         return self.choices_dict.get(choice, choice)
 
     def get_choices_add(self, qs):
-        count_dict = self.get_values_counts(qs)
-        choices = []
+        count_dict, has_more = self.truncate_counts(self.get_values_counts(qs))
+        approximate = is_approximate(count_dict)
+        choices = ChoiceList(has_more=has_more)
         for val, display in self.field_obj.choices:
             # 1), 2) above
             if val in count_dict:
@@ -370,7 +662,8 @@ class ChoicesFilter(ValuesFilter):
                 choices.append(FilterChoice(self.render_choice_object(val),
                                             count_dict[val],
                                             self.build_params(add=choice),
-                                            FILTER_ADD))
+                                            FILTER_ADD,
+                                            approximate))
         return choices
 
 
@@ -381,6 +674,11 @@ class ForeignKeyFilter(ChooseOnceMixin,
     """
     Filter for ForeignKey fields.
     """
+    def __init__(self, *args, **kwargs):
+        self.label_fields = kwargs.pop('label_fields', None)
+        self.label_func = kwargs.pop('label_func', None)
+        super(ForeignKeyFilter, self).__init__(*args, **kwargs)
+
     def choice_from_param(self, param):
         if param is None:
             return self.field_obj.to_python(param)
@@ -393,73 +691,154 @@ class ForeignKeyFilter(ChooseOnceMixin,
                 raise ValueError("object does not exist in DB")
             return obj
 
+    def choices_from_params(self):
+        # As for ManyToManyFilter, the objects for all params are fetched with
+        # a single query.
+        values = []
+        for p in self.params.getlist(self.query_param):
+            try:
+                values.append(
+                    super(ForeignKeyFilter, self).choice_from_param(p))
+            except ValueError:
+                pass
+        obj_dict = get_related_objects(self.rel_model, self.rel_field, values,
+                                       self.cache_related)
+        out = [obj_dict[v] for v in values if v in obj_dict]
+        for p in self.params.getlist(self.query_param + '--isnull'):
+            out.append(self.choice_from_param(None))
+        return out
+
     def param_from_choice(self, choice):
         if hasattr(choice, 'pk'):
             return six.text_type(choice.pk)
         else:
             return super(ForeignKeyFilter, self).param_from_choice(choice)
 
-    def get_choices_add(self, qs):
-        count_dict = self.get_values_counts(qs)
-        lookup = {self.rel_field.name + '__in': count_dict.keys()}
-        objs = self.rel_model.objects.filter(**lookup)
-        choices = []
+    def get_count_queries(self, qs):
+        if self.label_fields:
+            return {}
+        return super(ForeignKeyFilter, self).get_count_queries(qs)
 
-        null_count = (not self.chosen
-                      and self.field_obj.null
-                      and qs.filter(**{self.field + '__isnull': True}).count())
-        if null_count:
+    def get_labelled_counts(self, qs):
+        """
+        For the label_fields option, returns a SortedDict of {value: count}
+        and a dictionary of {value: label}, using a single query.
+        """
+        labels = {}
+
+        def counts(qs, *args):
+            count_dict, found = value_label_counts(
+                qs, self.field,
+                [self.field + '__' + f for f in self.label_fields], *args)
+            labels.update(found)
+            return count_dict
+        count_dict = self.get_counts(counts, qs, self.get_counts_limit(),
+                                     self.order_by_count)
+        return count_dict, dict((val, self.make_label(vals))
+                                for val, vals in labels.items())
+
+    def make_label(self, values):
+        """
+        Returns the label for a choice, from the values of label_fields.
+        """
+        if self.label_func is not None:
+            return self.label_func(dict(zip(self.label_fields, values)))
+        return ' '.join(six.text_type(v) for v in values)
+
+    def get_choices_add(self, qs):
+        if self.label_fields:
+            return self.get_labelled_choices_add(qs)
+        count_dict, has_more = self.truncate_counts(self.get_values_counts(qs))
+        objs = self.get_related_choices(qs.values(self.field), count_dict,
+                                        self.rel_field, has_more)
+        choices = ChoiceList(has_more=has_more)
+
+        approximate = is_approximate(count_dict)
+        # The count of NULLs comes with the other counts.
+        if None in count_dict:
             choices.append(FilterChoice(self.render_choice_object(NullChoice),
-                                        null_count,
+                                        count_dict[None],
                                         self.build_params(add=NullChoice),
-                                        FILTER_ADD))
+                                        FILTER_ADD,
+                                        approximate))
 
         for o in objs:
             pk = getattr(o, self.rel_field.attname)
+            if pk not in count_dict:
+                continue
             choices.append(FilterChoice(self.render_choice_object(o),
                                         count_dict[pk],
                                         self.build_params(add=o),
-                                        FILTER_ADD))
+                                        FILTER_ADD,
+                                        approximate))
 
         return choices
 
+    def get_labelled_choices_add(self, qs):
+        # Like get_choices_add, but without creating model instances.
+        count_dict, labels = self.get_labelled_counts(qs)
+        count_dict, has_more = self.truncate_counts(count_dict)
+        approximate = is_approximate(count_dict)
+        show_counts = self.show_counts or self.order_by_count
+        choices = ChoiceList(has_more=has_more)
+        for val, count in count_dict.items():
+            if val is None:
+                choice, label = NullChoice, self.render_choice_object(NullChoice)
+            else:
+                choice, label = val, labels[val]
+            choices.append(FilterChoice(label,
+                                        count if show_counts else None,
+                                        self.build_params(add=choice),
+                                        FILTER_ADD,
+                                        approximate))
+        return choices
 
-class ManyToManyFilter(ChooseAgainMixin, RelatedObjectMixin, Filter):
-
-    def get_values_counts(self, qs):
-        # It is easiest to base queries around the intermediate table, in order
-        # to get counts.
-        through = self.field_obj.rel.through
-        rel_model = self.rel_model
-
-        assert rel_model != self.model, "Can't cope with this yet..."
-        fkey_this = [f for f in through._meta.fields
-                     if f.rel is not None and f.rel.to is self.model][0]
-        fkey_other = [f for f in through._meta.fields
-                      if f.rel is not None and f.rel.to is rel_model][0]
 
-        # We need to limit items by what is in the main QuerySet (which might
-        # already be filtered).
-        m2m_objs = through.objects.filter(**{fkey_this.name + '__in': qs})
+class ManyToManyFilter(ChooseAgainMixin, RelatedObjectMixin, Filter):
 
-        # We need to exclude items in other table that we have already filtered
-        # on, because they are not interesting.
-        m2m_objs = m2m_objs.exclude(**{fkey_other.name + '__in': self.chosen})
+    def get_through_fields(self):
+        """
+        Returns the fields of the intermediate table pointing to the model and
+        to the related model (which can be the same model).
+        """
+        opts = self.field_obj.rel.through._meta
+        return (opts.get_field(self.field_obj.m2m_field_name()),
+                opts.get_field(self.field_obj.m2m_reverse_field_name()))
 
-        # Now get counts:
-        field_name = fkey_other.name
-        return value_counts(m2m_objs, field_name)
+    def get_values_counts(self, qs):
+        count_dict = self.get_prefetched_counts(qs, 'values')
+        if count_dict is None:
+            # The intermediate table is joined to qs and grouped by the
+            # related object, excluding the objects already chosen.
+            count_dict = self.get_counts(m2m_value_counts, qs,
+                                         self.get_through_fields(),
+                                         [o.pk for o in self.chosen],
+                                         self.get_counts_limit(),
+                                         self.order_by_count)
+        return count_dict
+
+    def get_count_queries(self, qs):
+        if self.approximate or self.max_choices is not None:
+            return {}
+        return {'values': m2m_value_counts_query(qs, self.get_through_fields(),
+                                                 [o.pk for o in self.chosen])}
 
     def get_choices_add(self, qs):
-        count_dict = self.get_values_counts(qs)
-        # Now, need to lookup objects on related table, to display them.
-        objs = self.rel_model.objects.filter(pk__in=count_dict.keys())
-
-        return [FilterChoice(self.render_choice_object(o),
-                             count_dict[o.pk],
-                             self.build_params(add=o),
-                             FILTER_ADD)
-                for o in objs]
+        count_dict, has_more = self.truncate_counts(self.get_values_counts(qs))
+        # Now, need to lookup objects on related table, to display them. The
+        # counts come from a join that the ORM can't express, so the objects
+        # are looked up by their keys rather than by a subquery.
+        objs = self.get_related_choices(None, count_dict,
+                                        self.rel_model._meta.pk, has_more)
+
+        approximate = is_approximate(count_dict)
+        return ChoiceList([FilterChoice(self.render_choice_object(o),
+                                        count_dict[o.pk],
+                                        self.build_params(add=o),
+                                        FILTER_ADD,
+                                        approximate)
+                           for o in objs if o.pk in count_dict],
+                          has_more)
 
     def param_from_choice(self, choice):
         return six.text_type(choice.pk)
@@ -470,10 +849,10 @@ class ManyToManyFilter(ChooseAgainMixin, RelatedObjectMixin, Filter):
         # multiple queries. So 'choice_from_param' technically returns the
         # wrong type of thing, since it returns PKs not instances.
         chosen_pks = super(ManyToManyFilter, self).choices_from_params()
-        objs = self.rel_model.objects.filter(pk__in=chosen_pks)
+        obj_dict = get_related_objects(self.rel_model, self.rel_model._meta.pk,
+                                       chosen_pks, self.cache_related)
         # Now need to get original order back. But also need to be aware
         # that some things may not exist in DB
-        obj_dict = dict([(obj.pk, obj) for obj in objs])
         retval = []
         for c in chosen_pks:
             if c in obj_dict:
@@ -545,6 +924,40 @@ DAYGROUP = DateRangeType(3,     False, 'day',   _ymd)
 DAY = DateRangeType(3,          True,  'day',   _ymd)
 
 
+def truncate_date(dt, range_type):
+    """
+    Returns the date or datetime dt truncated to the start of its year, month
+    or day, depending on range_type.
+    """
+    fields = {}
+    if range_type.level < MONTH.level:
+        fields['month'] = 1
+    if range_type.level < DAY.level:
+        fields['day'] = 1
+    if isinstance(dt, datetime):
+        fields.update(hour=0, minute=0, second=0, microsecond=0)
+    tzinfo = getattr(dt, 'tzinfo', None)
+    if hasattr(tzinfo, 'localize'):
+        # pytz timezones need to work out the offset for the new date.
+        return tzinfo.localize(dt.replace(tzinfo=None, **fields))
+    return dt.replace(**fields)
+
+
+def rollup_date_counts(rows, range_type):
+    """
+    Sums the counts of a list of (date, count) rows, sorted by date, for each
+    period of range_type. Returns a list of the same type.
+    """
+    out = rows.__class__()
+    for dt, count in rows:
+        dt = truncate_date(dt, range_type)
+        if out and out[-1][0] == dt:
+            out[-1][1] += count
+        else:
+            out.append([dt, count])
+    return out
+
+
 class NullChoice(object):
     def make_lookup(self, field_name):
         return {field_name+"__isnull": True}
@@ -559,7 +972,7 @@ class NullChoice(object):
     def __eq__(self, other):
         return other is NullChoice
 
-    range_type = values = None
+    range_type = values = sort_key = None
 NullChoice = NullChoice()
 
 
@@ -577,24 +990,91 @@ class AnyChoice(object):
     def __eq__(self, other):
         return other is AnyChoice
 
-    range_type = values = None
+    range_type = values = sort_key = None
 AnyChoice = AnyChoice()
 
 
+class FrozenChoice(object):
+    """
+    Base class for choice objects, whose attributes can't be changed once they
+    are built. This lets instances be shared, through shared(), from a table
+    per class that is emptied when it holds max_shared choices.
+    """
+    __slots__ = ()
+    max_shared = 1000
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are immutable" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s objects are immutable" % type(self).__name__)
+
+    def set_attributes(self, **attrs):
+        # Only for use by __init__
+        for name, value in attrs.items():
+            object.__setattr__(self, name, value)
+
+    def __hash__(self):
+        # Subclasses that define __eq__ need to set __hash__ again, for Python
+        # 3.
+        return hash(self.sort_key)
+
+    @classmethod
+    def shared(cls, key, *args):
+        """
+        Returns the choice built from args, shared with earlier calls that
+        used the same key.
+        """
+        try:
+            return cls.shared_choices[key]
+        except KeyError:
+            pass
+        if len(cls.shared_choices) >= cls.max_shared:
+            cls.shared_choices.clear()
+        choice = cls.shared_choices[key] = cls(*args)
+        return choice
+
+
+def parse_date_value(value):
+    """
+    Returns the date for a year, month or day in a DateChoice value, with the
+    parts it doesn't have set to 1, so that e.g. '2000' becomes 2000-1-1.
+    """
+    parts = [int(p) for p in value.split('-')]
+    return date(*(parts + [1] * (3 - len(parts))))
+
+
 @python_2_unicode_compatible
 @total_ordering
-class DateChoice(object):
+class DateChoice(FrozenChoice):
     """
     Represents a choice of date. Params are converted to this, and this is used
     to build new params and format links.
 
     It can represent a year, month or day choice, or a range (start, end, both
-    inclusive) of any of these choice.
+    inclusive) of any of these choice. The values are parsed to dates once,
+    and the key for sorting is worked out once.
     """
+    __slots__ = ('range_type', 'values', 'dates', 'sort_key')
+    shared_choices = {}
+
+    def __init__(self, range_type, values, dates=None):
+        values = tuple(values)
+        if dates is None:
+            dates = [parse_date_value(v) for v in values]
+        self.set_attributes(range_type=range_type, values=values,
+                            dates=tuple(dates),
+                            sort_key=(range_type.level, range_type.single,
+                                      values))
 
-    def __init__(self, range_type, values):
-        self.range_type = range_type
-        self.values = values
+    @classmethod
+    def get(cls, range_type, values, dates=None):
+        """
+        Returns the shared DateChoice for range_type and values.
+        """
+        values = tuple(values)
+        return cls.shared((range_type.level, range_type.single, values),
+                          range_type, values, dates)
 
     def __str__(self):
         # This is called when converting to URL
@@ -609,30 +1089,32 @@ class DateChoice(object):
     def __lt__(self, other):
         return self.__cmp__(other) < 0
 
+    __hash__ = FrozenChoice.__hash__
+
     def __cmp__(self, other):
         # 'greater' means more specific.
-        if other is None:
+        if other is None or other.sort_key is None:
             return 1
         else:
-            return cmp((self.range_type, self.values),
-                       (other.range_type, other.values))
+            return cmp(self.sort_key, other.sort_key)
 
     def display(self):
         # Called for user presentable string
         if self.range_type.single:
-            value = self.values[0]
-            parts = value.split('-')
-            if self.range_type is YEAR:
-                return parts[0]
-            elif self.range_type is MONTH:
-                return six.text_type(MONTHS[int(parts[1])])
-            elif self.range_type is DAY:
-                return str(int(parts[-1]))
+            return self.display_date(self.range_type, self.dates[0])
+        else:
+            range_type = DateRangeType.get(self.range_type.level, True)
+            return u'-'.join([self.display_date(range_type, d)
+                              for d in self.dates])
+
+    @staticmethod
+    def display_date(range_type, d):
+        if range_type is YEAR:
+            return '%04d' % d.year
+        elif range_type is MONTH:
+            return six.text_type(MONTHS[d.month])
         else:
-            return u'-'.join([DateChoice(
-                             DateRangeType.get(self.range_type.level,
-                                               True), [val]).display()
-                for val in self.values])
+            return str(d.day)
 
     @staticmethod
     def datetime_to_value(range_type, dt):
@@ -643,16 +1125,25 @@ class DateChoice(object):
         else:
             return '%04d-%02d-%02d' % (dt.year, dt.month, dt.day)
 
+    @staticmethod
+    def datetime_to_date(range_type, dt):
+        return date(dt.year,
+                    dt.month if range_type.level >= MONTH.level else 1,
+                    dt.day if range_type.level >= DAY.level else 1)
+
     @staticmethod
     def from_datetime(range_type, dt):
-        return DateChoice(range_type,
-                          [DateChoice.datetime_to_value(range_type, dt)])
+        return DateChoice.get(range_type,
+                              [DateChoice.datetime_to_value(range_type, dt)],
+                              [DateChoice.datetime_to_date(range_type, dt)])
 
     @staticmethod
     def from_datetime_range(range_type, dt1, dt2):
-        return DateChoice(DateRangeType.get(range_type.level, False),
-                          [DateChoice.datetime_to_value(range_type, dt1),
-                           DateChoice.datetime_to_value(range_type, dt2)])
+        return DateChoice.get(DateRangeType.get(range_type.level, False),
+                              [DateChoice.datetime_to_value(range_type, dt1),
+                               DateChoice.datetime_to_value(range_type, dt2)],
+                              [DateChoice.datetime_to_date(range_type, dt1),
+                               DateChoice.datetime_to_date(range_type, dt2)])
 
     @staticmethod
     def from_param(param):
@@ -661,26 +1152,16 @@ class DateChoice(object):
         for drt in DateRangeType.all.values():
             m = drt.regex.match(param)
             if m is not None:
-                return DateChoice(drt, list(m.groups()))
+                return DateChoice.get(drt, m.groups())
         raise ValueError()
 
     def make_lookup(self, field_name):
         # It's easier to do this all using datetime comparisons than have a
         # separate path for the single year/month/day case.
         if self.range_type.single:
-            start, end = self.values[0], self.values[0]
+            start_date = end_date = self.dates[0]
         else:
-            start, end = self.values
-
-        start_parts = list(map(int, start.split('-')))
-        end_parts = list(map(int, end.split('-')))
-
-        # Fill the parts we don't have with '1' so that e.g. 2000 becomes
-        # 2000-1-1
-        start_parts = start_parts + [1] * (3 - len(start_parts))
-        end_parts = end_parts + [1] * (3 - len(end_parts))
-        start_date = date(start_parts[0], start_parts[1], start_parts[2])
-        end_date = date(end_parts[0], end_parts[1], end_parts[2])
+            start_date, end_date = self.dates
 
         # Now add one year/month/day:
         end_date = end_date + \
@@ -698,11 +1179,18 @@ class DateTimeFilter(RangeFilterMixin, Filter):
                         'month': MONTH.level,
                         None: DAY.level + 1}
 
+    histogram_types = {'month': MONTH,
+                       'day': DAY,
+                       None: None}
+
     def __init__(self, *args, **kwargs):
         self.max_links = kwargs.pop('max_links', 12)
         self.max_depth = kwargs.pop('max_depth', None)
         assert self.max_depth in ['year', 'month', None]
         self.max_depth_level = self.max_depth_levels[self.max_depth]
+        self.histogram = kwargs.pop('histogram', None)
+        assert self.histogram in ['month', 'day', None]
+        self.cache_histogram = kwargs.pop('cache_histogram', False)
         super(DateTimeFilter, self).__init__(*args, **kwargs)
 
     def render_choice_object(self, choice):
@@ -730,60 +1218,16 @@ class DateTimeFilter(RangeFilterMixin, Filter):
         if NullChoice in chosen:
             return []
 
-        # For the case of needing to drill down past a single option
-        # to get to some real choices, we define a recursive
-        # function.
-
-        def get_choices_add_recursive(chosen):
-            range_type = None
-
-            if len(chosen) > 0:
-                range_type = chosen[-1].range_type.drilldown()
-                if range_type is None:
-                    return []
+        # With the 'histogram' option, the counts for all levels down to the
+        # histogram's are worked out from a single query.
+        histogram_type = self.get_histogram_type()
+        histogram = histogram_nulls = None
+        if histogram_type is not None:
+            histogram, histogram_nulls = self.get_histogram(qs, histogram_type)
 
-            if range_type is None:
-                # Get some initial idea of range
-                date_range = qs.aggregate(first=models.Min(self.field),
-                                          last=models.Max(self.field))
-                first = date_range['first']
-                last = date_range['last']
-                if first is None or last is None:
-                    # No values, can't drill down:
-                    return []
-                if first.year == last.year:
-                    if first.month == last.month:
-                        range_type = DAY
-                    else:
-                        range_type = MONTH
-                else:
-                    range_type = YEAR
-
-            if (VERSION >= (1, 6) and isinstance(self.field_obj,
-                                                 models.fields.DateTimeField)):
-                date_qs = qs.datetimes(self.field, range_type.label)
-            else:
-                date_qs = qs.dates(self.field, range_type.label)
-
-            results = date_aggregation(date_qs)
-
-            date_choice_counts = self.collapse_results(results, range_type)
-            if len(date_choice_counts) == 1 and range_type is not None:
-                # Single choice - recurse.
-                single_choice, count = date_choice_counts[0]
-                date_choice_counts_deeper = \
-                    get_choices_add_recursive([single_choice])
-                if len(date_choice_counts_deeper) == 0:
-                    # Nothing there, so ignore
-                    return date_choice_counts
-                else:
-                    # We discard date_choice_counts, because bridge_choices will
-                    # make it up again.
-                    return date_choice_counts_deeper
-            else:
-                return date_choice_counts
-
-        date_choice_counts = get_choices_add_recursive(chosen)
+        date_choice_counts, approximate, null_count = \
+            self.get_date_choice_counts(qs, chosen, histogram_type, histogram,
+                                        histogram_nulls)
 
         choices = []
         # Additional display links, to give context for choices if necessary.
@@ -791,15 +1235,22 @@ class DateTimeFilter(RangeFilterMixin, Filter):
             choices.extend(self.bridge_choices(
                 chosen, [choice for choice, count in date_choice_counts]))
 
-        null_count = (not chosen
-                      and qs.filter(**{self.field + '__isnull': True}).count())
+        null_qs = qs.filter(**{self.field + '__isnull': True})
+        if chosen:
+            null_count = 0
+        elif null_count is None and approximate:
+            null_count = (sample_queryset(null_qs, self.sample_every).count()
+                          * self.sample_every)
+        elif null_count is None:
+            null_count = null_qs.count()
 
         if null_count:
             choices.append(
                 FilterChoice(self.render_choice_object(NullChoice),
                              null_count if self.show_counts else None,
                              self.build_params(add=NullChoice),
-                             FILTER_ADD))
+                             FILTER_ADD,
+                             approximate))
 
         for date_choice, count in date_choice_counts:
             if date_choice in chosen:
@@ -820,9 +1271,200 @@ class DateTimeFilter(RangeFilterMixin, Filter):
             choices.append(FilterChoice(self.render_choice_object(date_choice),
                                         count if self.show_counts else None,
                                         self.build_params(add=date_choice),
-                                        link_type))
+                                        link_type,
+                                        approximate))
         return choices
 
+    def get_date_choice_counts(self, qs, chosen, histogram_type, histogram,
+                               histogram_nulls):
+        """
+        Returns a list of (DateChoice, count) for the level below 'chosen',
+        drilling down past single options to get to some real choices, along
+        with whether those counts came from a sample, and the count of NULLs if
+        it was found by the same queries (otherwise None).
+        """
+        null_count = None
+        count_nulls = False
+        if chosen:
+            range_type = chosen[-1].range_type.drilldown()
+            if range_type is None:
+                return [], False, None
+        elif histogram_type is not None:
+            null_count = histogram_nulls
+            if not histogram:
+                return [], False, null_count
+            range_type = self.initial_range_type(histogram[0][0],
+                                                 histogram[-1][0])
+        else:
+            first, last, null_count, count_nulls = self.get_date_bounds(qs)
+            if first is None or last is None:
+                # No values, can't drill down:
+                return [], False, null_count
+            range_type = self.initial_range_type(first, last)
+
+        if (histogram_type is not None and
+                range_type.level <= histogram_type.level):
+            results = rollup_date_counts(histogram, range_type)
+        else:
+            results = self.get_prefetched_counts(qs, range_type.label)
+        if results is None and count_nulls:
+            null_qs = qs.filter(**{self.field + '__isnull': True})
+            results, nulls = combined_counts(
+                [date_aggregation_query(self.date_queryset(qs, range_type)),
+                 value_counts_query(null_qs, self.field)], qs.db)
+            null_count = nulls.get(None, 0)
+        if results is None:
+            results = self.get_counts(
+                lambda qs: date_aggregation(self.date_queryset(qs,
+                                                               range_type)),
+                qs)
+        approximate = is_approximate(results)
+
+        date_choice_counts = self.collapse_results(results, range_type)
+        if len(date_choice_counts) == 1:
+            # Single choice - recurse. If there is nothing deeper, we keep
+            # this level, otherwise we discard it, because bridge_choices will
+            # make it up again.
+            single_choice, count = date_choice_counts[0]
+            deeper, deeper_approximate, _ = self.get_date_choice_counts(
+                qs, [single_choice], histogram_type, histogram, None)
+            if deeper:
+                return deeper, deeper_approximate, null_count
+        return date_choice_counts, approximate, null_count
+
+    def get_date_bounds(self, qs):
+        """
+        Returns the first and last dates in qs, the count of NULLs (or None if
+        it was not found by the same query), and whether the count of NULLs
+        should come with the first date counts instead.
+        """
+        bounds = self.get_cached_bounds(qs)
+        if bounds is not None:
+            first, last = bounds
+            return first, last, None, not self.approximate
+        # Get some initial idea of range, and the number of NULLs
+        aggregates = dict(first=models.Min(self.field),
+                          last=models.Max(self.field))
+        if not self.approximate:
+            aggregates.update(rows=models.Count('pk'),
+                              values=models.Count(self.field))
+        date_range = qs.aggregate(**aggregates)
+        null_count = None
+        if not self.approximate:
+            null_count = date_range['rows'] - date_range['values']
+        self.set_cached_bounds(qs, date_range['first'], date_range['last'])
+        return date_range['first'], date_range['last'], null_count, False
+
+    @staticmethod
+    def initial_range_type(first, last):
+        """
+        Returns the DateRangeType to show dates from first to last with.
+        """
+        if first.year == last.year:
+            if first.month == last.month:
+                return DAY
+            return MONTH
+        return YEAR
+
+    def date_queryset(self, qs, range_type):
+        if (VERSION >= (1, 6) and isinstance(self.field_obj,
+                                             models.fields.DateTimeField)):
+            return qs.datetimes(self.field, range_type.label)
+        else:
+            return qs.dates(self.field, range_type.label)
+
+    def get_histogram_type(self):
+        """
+        Returns the DateRangeType of the histogram to fetch, or None if the
+        'histogram' option is off or the choices are below its level.
+        """
+        histogram_type = self.histogram_types[self.histogram]
+        chosen = list(self.chosen)
+        if histogram_type is None or not chosen:
+            return histogram_type
+        if NullChoice in chosen:
+            return None
+        range_type = chosen[-1].range_type.drilldown()
+        if range_type is None or range_type.level > histogram_type.level:
+            return None
+        return histogram_type
+
+    def get_histogram_queries(self, qs, histogram_type):
+        queries = {'histogram': date_aggregation_query(
+            self.date_queryset(qs, histogram_type))}
+        if not self.chosen:
+            null_qs = qs.filter(**{self.field + '__isnull': True})
+            queries['nulls'] = value_counts_query(null_qs, self.field)
+        return queries
+
+    def histogram_counts(self, qs, histogram_type, results=None):
+        """
+        Returns the rows of (date, count) for the histogram, with the count of
+        NULLs first if they are needed. results are the prefetched results of
+        get_histogram_queries, if any.
+        """
+        if results is None:
+            queries = self.get_histogram_queries(qs, histogram_type)
+            results = dict(zip(queries, combined_counts(list(queries.values()),
+                                                        qs.db)))
+        rows = list(results['histogram'])
+        if 'nulls' in results:
+            rows.insert(0, [None, results['nulls'].get(None, 0)])
+        return rows
+
+    def histogram_key(self, qs, histogram_type):
+        return date_histograms.make_key(qs, self.field, histogram_type.label,
+                                        bool(self.chosen),
+                                        self.approximate and self.sample_every)
+
+    def get_histogram(self, qs, histogram_type):
+        """
+        Returns the counts of dates in qs truncated to histogram_type, as a
+        list of (date, count) rows, and the count of NULLs (None if nothing is
+        chosen, since there are none).
+        """
+        if self.cache_histogram:
+            key = self.histogram_key(qs, histogram_type)
+            cached = date_histograms.get(key)
+            if cached is not None:
+                return cached
+        results = dict((k, self.get_prefetched_counts(qs, k))
+                       for k in ['histogram', 'nulls'])
+        if results['histogram'] is not None:
+            rows = self.histogram_counts(qs, histogram_type,
+                                         dict((k, v) for k, v in results.items()
+                                              if v is not None))
+        else:
+            rows = self.get_counts(self.histogram_counts, qs, histogram_type)
+        null_count = None
+        if rows and rows[0][0] is None:
+            null_count = rows[0][1]
+        histogram = (rows.__class__(row for row in rows if row[0] is not None),
+                     null_count)
+        if self.cache_histogram:
+            date_histograms.set(key, qs, histogram, rows=len(histogram[0]))
+        return histogram
+
+    def get_count_queries(self, qs):
+        chosen = list(self.chosen)
+        histogram_type = self.get_histogram_type()
+        if histogram_type is not None:
+            if self.approximate or (
+                    self.cache_histogram and date_histograms.get(
+                        self.histogram_key(qs, histogram_type)) is not None):
+                return {}
+            return self.get_histogram_queries(qs, histogram_type)
+        # Without anything chosen, the range type to start at depends on the
+        # result of an aggregate query, so only the drill down from a chosen
+        # date can be planned.
+        if not chosen or NullChoice in chosen or self.approximate:
+            return {}
+        range_type = chosen[-1].range_type.drilldown()
+        if range_type is None:
+            return {}
+        return {range_type.label:
+                date_aggregation_query(self.date_queryset(qs, range_type))}
+
     def collapse_results(self, results, range_type):
         if len(results) > self.max_links:
             # If range_type is month/day, we don't want any possibility of the
@@ -902,8 +1544,8 @@ class DateTimeFilter(RangeFilterMixin, Filter):
                 chosen_level += 1
             if chosen_level > self.max_depth_level:
                 continue
-            date_choice = DateChoice(DateRangeType.get(chosen_level, True),
-                                     new_choice.values)
+            date_choice = DateChoice.get(DateRangeType.get(chosen_level, True),
+                                         new_choice.values, new_choice.dates)
             retval.append(FilterChoice(self.render_choice_object(date_choice),
                                        None, None,
                                        FILTER_DISPLAY))
@@ -911,14 +1553,37 @@ class DateTimeFilter(RangeFilterMixin, Filter):
         return retval
 
 
-class RangeEnd(object):
+class RangeEnd(namedtuple('RangeEnd', 'value inclusive')):
     """
-    Simple structure to store part of a range
+    Simple immutable structure to store part of a range. value is some generic
+    value, inclusive is a bool specifying where this value is included as part
+    of the range.
     """
-    def __init__(self, value, inclusive):
-        # value is some generic value, inclusive is a bool specifying where this
-        # value is included as part of the range.
-        self.value, self.inclusive = value, inclusive
+    __slots__ = ()
+
+
+def bin_in_range(lowest, highest, values):
+    """
+    Returns True if all values from lowest to highest are in the range given
+    by the RangeEnd objects in values (as in NumericRangeChoice), False if
+    none of them are, or None if it depends on the values in between.
+    """
+    if len(values) == 1:
+        start = end = RangeEnd(values[0].value, True)
+    else:
+        start, end = values
+
+    def above_start(val):
+        return val > start.value or (start.inclusive and val == start.value)
+
+    def below_end(val):
+        return val < end.value or (end.inclusive and val == end.value)
+
+    if above_start(lowest) and below_end(highest):
+        return True
+    if not above_start(highest) or not below_end(lowest):
+        return False
+    return None
 
 
 def make_numeric_range_choice(to_python, to_str):
@@ -929,11 +1594,32 @@ def make_numeric_range_choice(to_python, to_str):
     """
     @python_2_unicode_compatible
     @total_ordering
-    class NumericRangeChoice(object):
+    class NumericRangeChoice(FrozenChoice):
+        __slots__ = ('values', 'sort_key')
+        shared_choices = {}
 
         def __init__(self, values):
             # Values are instances of RangeEnd
-            self.values = tuple(values)
+            values = tuple(values)
+            # One value is more specific than two, and a smaller difference
+            # is more specific.
+            if len(values) == 1:
+                sort_key = (1, 0)
+            else:
+                sort_key = (0, values[0].value - values[1].value)
+            self.set_attributes(values=values, sort_key=sort_key)
+
+        @classmethod
+        def get(cls, values):
+            """
+            Returns the shared NumericRangeChoice for the RangeEnds in values.
+            """
+            values = tuple(values)
+            # Equal numbers can have different types or precisions (e.g.
+            # Decimal('1.0') and Decimal('1.00')), which show differently.
+            key = tuple((type(v.value), to_str(v.value), v.inclusive)
+                        for v in values)
+            return cls.shared(key, values)
 
         def display(self):
             return '-'.join([str(v.value) for v in self.values])
@@ -955,7 +1641,7 @@ def make_numeric_range_choice(to_python, to_str):
                     vals.append(RangeEnd(val, inclusive))
                 except ValidationError:
                     raise ValueError()
-            return cls(vals)
+            return cls.get(vals)
 
         def make_lookup(self, field_name):
             if self.values is None:
@@ -982,6 +1668,8 @@ def make_numeric_range_choice(to_python, to_str):
         def __lt__(self, other):
             return self.__cmp__(other) < 0
 
+        __hash__ = FrozenChoice.__hash__
+
         def __cmp__(self, other):
             # 'greater' means more specific.
             if other is None:
@@ -989,27 +1677,31 @@ def make_numeric_range_choice(to_python, to_str):
             else:
                 if other is NullChoice:
                     return -1
-                if len(self.values) != len(other.values):
-                    # one value is more specific than two
-                    return -cmp(len(self.values), len(other.values))
-                elif len(self.values) == 1:
-                    return 0
-                else:
-                    # Larger difference means less specific
-                    return -cmp(self.values[1].value - self.values[0].value,
-                                other.values[1].value - other.values[0].value)
+                return cmp(self.sort_key, other.sort_key)
 
     return NumericRangeChoice
 
 
 class NumericRangeFilter(RangeFilterMixin, SingleValueMixin, Filter):
 
+    # Cache of choice_type for each field
+    _choice_types = {}
+
     def __init__(self, field, model, params, **kwargs):
         self.max_links = kwargs.pop('max_links', 5)
         self.drilldown = kwargs.pop('drilldown', True)
         self.ranges = kwargs.pop('ranges', None)
+        self.range_strategy = kwargs.pop('range_strategy', 'uniform')
+        assert self.range_strategy in ['uniform', 'quantile']
+        self.histogram_bins = kwargs.pop('histogram_bins', None)
+        self.histogram_base = None
         field_obj, _ = get_model_field(model, field)
-        self.choice_type = make_numeric_range_choice(field_obj.to_python, str)
+        try:
+            self.choice_type = self._choice_types[field_obj]
+        except KeyError:
+            self.choice_type = make_numeric_range_choice(field_obj.to_python,
+                                                         str)
+            self._choice_types[field_obj] = self.choice_type
         super(NumericRangeFilter, self).__init__(field, model, params, **kwargs)
 
     def render_choice_object(self, c):
@@ -1029,60 +1721,233 @@ class NumericRangeFilter(RangeFilterMixin, SingleValueMixin, Filter):
                     return c.display()
         return c.display()
 
+    def apply_filter(self, qs):
+        filtered = super(NumericRangeFilter, self).apply_filter(qs)
+        if self.histogram_bins:
+            # Choices can come from the histogram of the QuerySet without this
+            # filter, as long as no other filter narrows it down afterwards.
+            self.histogram_base = qs, queryset_fingerprint(filtered)
+        return filtered
+
     def get_choices_add(self, qs):
         chosen = list(self.chosen)
         if NullChoice in chosen or (not self.drilldown and len(chosen) > 0):
             return []
 
-        all_vals = qs.values_list(self.field).distinct()
+        if self.histogram_bins:
+            choices = self.get_histogram_choices(qs, chosen)
+            if choices is not None:
+                return choices
+
+        # Whether there are few enough values to list them only needs a probe
+        # for up to max_links + 1 distinct values (and NULL), rather than
+        # counting all of them. Automatic uniform ranges also need the bounds
+        # of the field, which come from the same statement.
+        stats = bounds = None
+        uniform = self.ranges is None and self.range_strategy == 'uniform'
+        if uniform:
+            bounds = self.get_cached_bounds(qs)
+        if uniform and bounds is None:
+            probe, stats = probe_values_and_bounds(qs, self.field,
+                                                   self.max_links + 2)
+            bounds = stats[:2]
+            self.set_cached_bounds(qs, *bounds)
+        else:
+            probe = list(qs.values_list(self.field, flat=True).order_by()
+                         .distinct()[:self.max_links + 2])
+        values = sorted(v for v in probe if v is not None)
 
-        num = all_vals.count()
+        if len(values) <= self.max_links:
+            if self.show_counts or self.order_by_count:
+                val_counts = self.get_counts(value_counts, qs, self.field)
+            else:
+                # The probe found all the values.
+                val_counts = SortedDict(
+                    ([(None, None)] if None in probe else []) +
+                    [(v, None) for v in values])
+            return self.value_choices(val_counts, is_approximate(val_counts))
+
+        if self.ranges is None and self.range_strategy == 'quantile':
+            ranges = self.get_quantile_ranges(qs)
+        elif self.ranges is None:
+            ranges = auto_ranges(bounds[0], bounds[1], self.max_links)
+        else:
+            ranges = self.ranges
 
-        choices = []
-        if num <= self.max_links:
-            val_counts = value_counts(qs, self.field)
-            for v, count in val_counts.items():
-                choice = (NullChoice if v is None
-                          else self.choice_type([RangeEnd(v, True)]))
-                choices.append(FilterChoice(self.render_choice_object(choice),
-                                            count if self.show_counts else None,
-                                            self.build_params(add=choice),
-                                            FILTER_ADD))
+        if self.show_counts or self.order_by_count:
+            val_counts = self.get_prefetched_counts(qs, 'ranges')
+            if val_counts is None:
+                # Manually specified ranges leave out values outside them.
+                val_counts = self.get_counts(numeric_range_counts, qs,
+                                             self.field, ranges,
+                                             self.ranges is None)
+            # The count of NULLs comes with the range counts.
+            val_counts = val_counts.copy()
+            null_count = val_counts.pop(None, 0)
         else:
-            null_count = (not chosen
-                          and qs.filter(**{self.field +
-                                           '__isnull': True}).count())
-            if null_count:
-                choice = NullChoice
-                choices.append(FilterChoice(self.render_choice_object(choice),
-                                            null_count if self.show_counts
-                                            else None,
-                                            self.build_params(add=choice),
-                                            FILTER_ADD))
-            if self.ranges is None:
-                val_range = qs.aggregate(
-                    lower=models.Min(self.field),
-                    upper=models.Max(self.field)
-                )
-                ranges = auto_ranges(val_range['lower'],
-                                     val_range['upper'],
-                                     self.max_links)
+            val_counts = SortedDict((val, None) for val in ranges)
+            if stats is None:
+                null_count = qs.filter(**{self.field +
+                                          '__isnull': True}).exists()
             else:
-                ranges = self.ranges
+                # Rows less non-NULL values, from the probe.
+                null_count = stats[2] - stats[3]
+        return self.range_choices(val_counts, null_count if not chosen else 0,
+                                  is_approximate(val_counts))
 
-            if self.show_counts or self.order_by_count:
-                val_counts = numeric_range_counts(qs, self.field, ranges)
-            else:
-                val_counts = dict((val, None) for val in ranges)
-            for i, (vals, count) in enumerate(val_counts.items()):
-                # For the lower bound, we make it inclusive only if it the first
-                # choice. The upper bound is always inclusive. This gives
-                # filters that behave sensibly e.g. with 10-20, 20-30, 30-40,
-                # the first will include 10 and 20, the second will exlude 20.
-                choice = self.choice_type([RangeEnd(vals[0], i == 0),
+    def value_choices(self, val_counts, approximate):
+        choices = []
+        for v, count in val_counts.items():
+            choice = (NullChoice if v is None
+                      else self.choice_type.get([RangeEnd(v, True)]))
+            choices.append(FilterChoice(self.render_choice_object(choice),
+                                        count if self.show_counts else None,
+                                        self.build_params(add=choice),
+                                        FILTER_ADD,
+                                        approximate))
+        return choices
+
+    def range_choices(self, val_counts, null_count, approximate):
+        choices = []
+        if null_count:
+            choice = NullChoice
+            choices.append(FilterChoice(self.render_choice_object(choice),
+                                        null_count if self.show_counts
+                                        else None,
+                                        self.build_params(add=choice),
+                                        FILTER_ADD,
+                                        approximate))
+        for i, (vals, count) in enumerate(val_counts.items()):
+            # For the lower bound, we make it inclusive only if it the first
+            # choice. The upper bound is always inclusive. This gives filters
+            # that behave sensibly e.g. with 10-20, 20-30, 30-40, the first
+            # will include 10 and 20, the second will exlude 20.
+            choice = self.choice_type.get([RangeEnd(vals[0], i == 0),
                                            RangeEnd(vals[1], True)])
-                choices.append(FilterChoice(self.render_choice_object(choice),
-                                            count,
-                                            self.build_params(add=choice),
-                                            FILTER_ADD))
+            choices.append(FilterChoice(self.render_choice_object(choice),
+                                        count,
+                                        self.build_params(add=choice),
+                                        FILTER_ADD,
+                                        approximate))
         return choices
+
+    def get_histogram(self, qs):
+        """
+        Returns the rows of numeric_histogram for the QuerySet without this
+        filter, from cache.numeric_histograms if possible, or None if that
+        QuerySet is not known.
+        """
+        if not self.chosen:
+            base = qs
+        elif (self.histogram_base is not None and
+              self.histogram_base[1] == queryset_fingerprint(qs)):
+            base = self.histogram_base[0]
+        else:
+            return None
+        key = numeric_histograms.make_key(base, self.field,
+                                          self.histogram_bins)
+        rows = numeric_histograms.get(key)
+        if rows is None:
+            bounds = self.get_cached_bounds(base)
+            if bounds is None:
+                bounds = base.aggregate(lower=models.Min(self.field),
+                                        upper=models.Max(self.field))
+                bounds = bounds['lower'], bounds['upper']
+                self.set_cached_bounds(base, *bounds)
+            if bounds[0] is None:
+                return None
+            rows = numeric_histogram(base, self.field,
+                                     histogram_grid(bounds[0], bounds[1],
+                                                    self.histogram_bins))
+            numeric_histograms.set(key, base, rows)
+        return rows
+
+    def get_histogram_choices(self, qs, chosen):
+        """
+        Returns the choices worked out from the histogram, or None if its bins
+        are too coarse for them.
+        """
+        if self.range_strategy == 'quantile':
+            return None
+        rows = self.get_histogram(qs)
+        if rows is None:
+            return None
+        null_count = 0
+        bins = []
+        for index, count, distinct, lowest, highest in rows:
+            if index == -1:
+                null_count = 0 if chosen else count
+                continue
+            inside = [bin_in_range(lowest, highest, c.values)
+                      for c in chosen]
+            if None in inside:
+                return None
+            if all(inside):
+                bins.append((count, distinct, lowest, highest))
+
+        counted = self.show_counts or self.order_by_count
+        if sum(distinct for _, distinct, _, _ in bins) <= self.max_links:
+            if any(distinct > 1 for _, distinct, _, _ in bins):
+                return None
+            val_counts = SortedDict(
+                ([(None, null_count if counted else None)]
+                 if null_count else []) +
+                [(lowest, count if counted else None)
+                 for count, _, lowest, _ in bins])
+            return self.value_choices(val_counts, False)
+
+        ranges = self.ranges
+        if ranges is None:
+            ranges = auto_ranges(bins[0][2], bins[-1][3], self.max_links)
+        counts = [0] * len(ranges)
+        for count, _, lowest, highest in bins:
+            for i, r in enumerate(ranges):
+                inside = bin_in_range(lowest, highest,
+                                      [RangeEnd(r[0], i == 0),
+                                       RangeEnd(r[1], True)])
+                if inside is None:
+                    return None
+                if inside:
+                    counts[i] += count
+                    break
+            else:
+                # Like numeric_range_counts, values outside automatic ranges
+                # are counted in the last one.
+                if self.ranges is None:
+                    counts[-1] += count
+        if counted:
+            val_counts = SortedDict((r, count) for r, count
+                                    in zip(ranges, counts) if count)
+        else:
+            val_counts = SortedDict((r, None) for r in ranges)
+        return self.range_choices(val_counts, null_count, False)
+
+    def get_quantile_ranges(self, qs):
+        """
+        Returns ranges with about the same number of values in each, cached in
+        cache.range_boundaries.
+        """
+        key = range_boundaries.make_key(qs, self.field, self.max_links,
+                                        self.sample_every)
+        ranges = range_boundaries.get(key)
+        if ranges is None:
+            ranges = quantile_ranges(quantile_bounds(qs, self.field,
+                                                     self.max_links,
+                                                     self.sample_every))
+            range_boundaries.set(key, qs, ranges)
+        return ranges
+
+    def get_count_queries(self, qs):
+        # Automatic ranges depend on the result of an aggregate query, so only
+        # counts for manually specified ranges can be planned.
+        chosen = list(self.chosen)
+        if (self.ranges is None
+                or self.histogram_bins
+                or self.approximate
+                or NullChoice in chosen
+                or (not self.drilldown and len(chosen) > 0)
+                or not (self.show_counts or self.order_by_count)):
+            return {}
+        return {'ranges': numeric_range_counts_query(qs, self.field,
+                                                     self.ranges,
+                                                     clamp=False)}
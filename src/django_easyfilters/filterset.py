@@ -8,6 +8,7 @@ from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
 from django.utils.translation import ugettext as _
 
+from .cache import FilterChoicesCache
 from .filters import ChoicesFilter
 from .filters import DateTimeFilter
 from .filters import FILTER_DISPLAY
@@ -16,8 +17,19 @@ from .filters import ForeignKeyFilter
 from .filters import ManyToManyFilter
 from .filters import NumericRangeFilter
 from .filters import ValuesFilter
+from .queries import combined_counts
+from .stats import FilterSetStats
+from .stats import FilterTiming
+from .stats import QueryCounter
+from .stats import filter_timed
+from .stats import has_receivers
+from .utils import call_in_worker_thread
+from .utils import can_use_other_connections
+from .utils import chain_future
 from .utils import get_model_field
+from .utils import get_thread_pool
 from .utils import python_2_unicode_compatible
+from .utils import run_in_executor
 
 try:
     from django.utils.functional import cached_property
@@ -39,6 +51,12 @@ except ImportError:
 logger = getLogger(__name__)
 
 
+def get_choices_in_thread(args):
+    filterset, filters = args
+    return call_in_worker_thread(
+        lambda: [(f, filterset.get_choices(f)) for f in filters])
+
+
 def non_breaking_spaces(val):
     # This helps a lot with presentation, by stopping the links+count from being
     # split over a line end.
@@ -54,28 +72,208 @@ class FilterSet(object):
     template = None
     template_file = "django_easyfilters/default.html"
 
+    # A dictionary of {field name: template file} for fields that need a
+    # different template.
+    field_templates = None
+
+    # Compiled templates, keyed by template source or file name. These are
+    # shared by all FilterSets, so that templates are only parsed once per
+    # process.
+    _compiled_templates = {}
+
+    # Results of get_filter_specs for each FilterSet class and model.
+    _filter_specs = {}
+
     title_fields = None
     defaults = None
 
+    # If True, the count queries of all filters that can be planned up front
+    # are run as a single SQL statement.
+    combine_queries = False
+
+    # The name of a cache (from the CACHES setting) used to store the choices of
+    # the filters, or None to disable caching.
+    cache_alias = None
+    cache_timeout = 300
+    choices_cache_class = FilterChoicesCache
+
+    # If True, the choices of different filters are computed concurrently in
+    # the pool of threads shared by the process (see utils.get_thread_pool),
+    # each with its own database connection. max_workers limits the number of
+    # threads used at once by a FilterSet.
+    concurrent_queries = False
+    max_workers = None
+
+    # If True, the time taken, queries run and rows fetched by each operation
+    # are recorded in self.stats. This is also done if there are receivers of
+    # the filter_timed signal for the class.
+    collect_stats = False
+
     def __init__(self, queryset, params):
         self.params = params
         self.model = queryset.model
+        self.stats = FilterSetStats()
+        self._instrumented = (self.collect_stats or
+                              has_receivers(filter_timed, type(self)))
         self.filters = self.setup_filters()
         self.qs = self.apply_filters(queryset)
+        self.choices_cache = self.get_choices_cache()
+        self._cached_filter_choices = {}
 
     @cached_property
     def title(self):
         return self.make_title()
 
+    # Asynchronous API. These methods return asyncio Futures that can be
+    # awaited from asynchronous code. The ORM is synchronous, so queries are
+    # run in the default executor of the event loop, with the queries for
+    # different filters running concurrently.
+
+    @classmethod
+    def acreate(cls, queryset, params):
+        """
+        Creates the FilterSet, including any queries needed to set up the
+        filters, in the executor.
+        """
+        return run_in_executor(queryset.db, cls, queryset, params)
+
+    def aget_filter_choices(self, filter_field):
+        future = self.aload_filter_choices([self.get_filter(filter_field)])
+        return chain_future(future,
+                            lambda _: self.get_filter_choices(filter_field))
+
+    def aload_filter_choices(self, filters):
+        import asyncio
+        if self.combine_queries:
+            # Running the filters separately would split the combined query.
+            return run_in_executor(self.qs.db, self.load_filter_choices,
+                                   filters)
+        return asyncio.gather(*[run_in_executor(self.qs.db,
+                                                self.load_filter_choices, [f])
+                                for f in filters])
+
+    def arender(self):
+        return chain_future(self.aload_filter_choices(self.filters),
+                            lambda _: self.render())
+
+    def atitle(self):
+        if self.title_fields is None:
+            filters = self.filters
+        else:
+            filters = [self.get_filter(f) for f in self.title_fields]
+        return chain_future(self.aload_filter_choices(filters),
+                            lambda _: self.title)
+
     def get_filter_choices(self, filter_field):
-        if not hasattr(self, '_cached_filter_choices'):
-            self._cached_filter_choices = dict((f.field, f.get_choices(self.qs))
-                                               for f in self.filters)
+        if filter_field not in self._cached_filter_choices:
+            self.load_filter_choices([self.get_filter(filter_field)])
         return self._cached_filter_choices[filter_field]
 
+    def get_filter(self, filter_field):
+        for f in self.filters:
+            if f.field == filter_field:
+                return f
+        raise KeyError(filter_field)
+
+    def load_filter_choices(self, filters):
+        """
+        Gets the choices for the filters that don't have them yet, so that only
+        the queries for the filters that are actually used are run, while
+        still running them together (combine_queries) or fetching them
+        together from the cache.
+        """
+        filters = [f for f in filters
+                   if f.field not in self._cached_filter_choices]
+        if not filters:
+            return
+        if self.choices_cache is None:
+            choices = self.compute_filter_choices(filters)
+        else:
+            choices = self.choices_cache.get_many_choices(
+                filters, self.qs, self.compute_filter_choices)
+        self._cached_filter_choices.update((f.field, c)
+                                           for f, c in choices.items())
+
+    def compute_filter_choices(self, filters):
+        if self.combine_queries:
+            self.prefetch_counts(filters)
+        if (self.concurrent_queries and len(filters) > 1
+                and self.can_run_concurrently()):
+            num_tasks = len(filters)
+            if self.max_workers is not None:
+                num_tasks = min(self.max_workers, num_tasks)
+            groups = [filters[i::num_tasks] for i in range(num_tasks)]
+            results = get_thread_pool().map(get_choices_in_thread,
+                                            [(self, g) for g in groups])
+            return dict(pair for result in results for pair in result)
+        return dict((f, self.get_choices(f)) for f in filters)
+
+    def get_choices(self, filter_):
+        return self.instrument('get_choices', filter_, self.qs.db,
+                               filter_.get_choices, self.qs)
+
+    def instrument(self, phase, filter_, using, func, *args):
+        """
+        Calls func(*args), recording the elapsed time and the number of
+        queries and rows on the 'using' database in self.stats, and sending
+        the filter_timed signal, if stats are collected.
+        """
+        if not self._instrumented:
+            return func(*args)
+        with QueryCounter(using) as counter:
+            result = func(*args)
+        if filter_ is None:
+            filter_class = field = None
+        else:
+            filter_class, field = type(filter_), filter_.field
+        timing = FilterTiming(phase, filter_class, field, counter.elapsed,
+                              counter.queries, counter.rows)
+        self.stats.add(timing)
+        filter_timed.send(sender=type(self), filterset=self, timing=timing)
+        return result
+
+    def can_run_concurrently(self):
+        return can_use_other_connections(self.qs.db)
+
+    def get_choices_cache(self):
+        if self.cache_alias is None:
+            return None
+        cache = self.choices_cache_class(self.cache_alias,
+                                         self.cache_timeout,
+                                         self.get_cache_namespace())
+        cache.watch(self.filters)
+        return cache
+
+    def get_cache_namespace(self):
+        # Different FilterSets can use different options for filters on the
+        # same field, so the namespace includes the 'fields' definition.
+        fields = []
+        for f in self.get_fields():
+            if isinstance(f, six.string_types):
+                fields.append(f)
+            else:
+                fields.append((f[0], sorted(f[1].items())) + tuple(f[2:]))
+        defaults = sorted((self.defaults or {}).items())
+        return '%s.%s:%r:%r' % (type(self).__module__, type(self).__name__,
+                                fields, defaults)
+
+    def prefetch_counts(self, filters):
+        planned = [(f, key, grouped_counts)
+                   for f in filters
+                   for key, grouped_counts in f.get_count_queries(self.qs).items()]
+        results = self.instrument('prefetch_counts', None, self.qs.db,
+                                  combined_counts, [p[2] for p in planned],
+                                  self.qs.db)
+        prefetched = dict((f, {}) for f in filters)
+        for (f, key, _gc), counts in zip(planned, results):
+            prefetched[f][key] = counts
+        for f, counts in prefetched.items():
+            f.set_prefetched_counts(self.qs, counts)
+
     def apply_filters(self, queryset):
         for f in self.filters:
-            queryset = f.apply_filter(queryset)
+            queryset = self.instrument('apply_filter', f, queryset.db,
+                                       f.apply_filter, queryset)
         return queryset
 
     def render_filter(self, filter_):
@@ -86,19 +284,36 @@ class FilterSet(object):
                                url=u'?' + c.params.urlencode()
                                    if c.link_type != FILTER_DISPLAY else None,
                                link_type=c.link_type,
-                               count=c.count)
+                               count=c.count,
+                               approximate=c.approximate)
                           for c in choices]
+        ctx['has_more'] = getattr(choices, 'has_more', False)
         return self.get_template(filter_.field).render(template.Context(ctx))
 
     def get_template(self, field_name):
-        if self.template:
-            return template.Template(self.template)
+        if self.field_templates and field_name in self.field_templates:
+            key = ('file', self.field_templates[field_name])
+        elif self.template:
+            key = ('source', self.template)
         else:
-            return get_template(self.template_file)
+            key = ('file', self.template_file)
+        try:
+            return self._compiled_templates[key]
+        except KeyError:
+            kind, value = key
+            if kind == 'source':
+                compiled = template.Template(value)
+            else:
+                compiled = get_template(value)
+            self._compiled_templates[key] = compiled
+            return compiled
 
     def render(self):
-        return mark_safe(u'\n'.join(self.render_filter(f)
-                         for f in self.filters))
+        self.load_filter_choices(self.filters)
+        return mark_safe(u'\n'.join(
+            self.instrument('render_filter', f, self.qs.db,
+                            self.render_filter, f)
+            for f in self.filters))
 
     def get_fields(self):
         return self.fields
@@ -121,20 +336,41 @@ class FilterSet(object):
             else:
                 return ValuesFilter
 
+    def get_filter_specs(self):
+        """
+        Returns a list of (filter class, field name, options) tuples for the
+        filters. These don't depend on params, so unless get_fields is
+        overridden they are worked out once per FilterSet class and model, and
+        each call gets its own copy of the options.
+        """
+        cacheable = (six.get_unbound_function(type(self).get_fields) is
+                     six.get_unbound_function(FilterSet.get_fields))
+        key = (type(self), self.model)
+        specs = self._filter_specs.get(key) if cacheable else None
+        if specs is None:
+            specs = []
+            for f in self.get_fields():
+                klass = None
+                opts = {} if self.defaults is None else dict(self.defaults)
+                if isinstance(f, six.string_types):
+                    field_name = f
+                else:
+                    opts.update(f[1])
+                    field_name = f[0]
+                    if len(f) > 2:
+                        klass = f[2]
+                if klass is None:
+                    klass = self.get_filter_for_field(field_name)
+                specs.append((klass, field_name, tuple(sorted(opts.items()))))
+            specs = tuple(specs)
+            if cacheable:
+                self._filter_specs[key] = specs
+        return [(klass, field_name, dict(opts))
+                for klass, field_name, opts in specs]
+
     def setup_filters(self):
         filters = []
-        for f in self.get_fields():
-            klass = None
-            opts = {} if self.defaults is None else dict(self.defaults)
-            if isinstance(f, six.string_types):
-                field_name = f
-            else:
-                opts.update(f[1])
-                field_name = f[0]
-                if len(f) > 2:
-                    klass = f[2]
-            if klass is None:
-                klass = self.get_filter_for_field(field_name)
+        for klass, field_name, opts in self.get_filter_specs():
             logger.debug("Creating %s(%s, %s, %s, **%s)",
                          klass.__name__,
                          field_name,
@@ -149,6 +385,7 @@ class FilterSet(object):
             title_fields = [filter_.field for filter_ in self.filters]
         else:
             title_fields = self.title_fields
+        self.load_filter_choices([self.get_filter(f) for f in title_fields])
         return u", ".join(c.label
                           for f in title_fields
                           for c in self.get_filter_choices(f)
@@ -1,4 +1,10 @@
+from datetime import date
+from datetime import time
+from decimal import Decimal
+import re
+
 from django import VERSION
+from django.db import connections
 from django.db import models
 from django.db.backends.util import typecast_timestamp
 from django.db.models.sql.compiler import SQLCompiler
@@ -10,6 +16,8 @@ except ImportError:
 from django.db.models.sql.subqueries import AggregateQuery
 from django.utils.datastructures import SortedDict
 
+from .utils import get_model_field
+
 
 # Some fairly brittle, low level stuff, to get the aggregation
 # queries we need.
@@ -28,16 +36,9 @@ class DateAggregateQuery(AggregateQuery):
 
 class DateAggregateCompiler(SQLCompiler):
     def results_iter(self):
-        needs_string_cast = self.connection.features.needs_datetime_string_cast
-
         for rows in self.execute_sql(MULTI):
             for row in rows:
-                if needs_string_cast:
-                    vals = [typecast_timestamp(str(row[0])),
-                            row[1]]
-                else:
-                    vals = row
-                yield vals
+                yield [convert_date(self.connection, row[0]), row[1]]
 
     def as_sql(self, qn=None):
         sql = ('SELECT %s, COUNT(%s) '
@@ -62,9 +63,27 @@ class DateWithAlias(Date):
                     + ' as ' + self.alias)
 
 
-def date_aggregation(date_qs):
+def convert_date(connection, value):
+    if connection.features.needs_datetime_string_cast and value is not None:
+        return typecast_timestamp(str(value))
+    return value
+
+
+def convert_value(connection, value, field):
     """
-    Performs an aggregation for a supplied DateQuerySet
+    Coerces a value selected through a subquery to the type used by 'field',
+    for backends that lose the column type (e.g. SQLite).
+    """
+    if (value is None or isinstance(value, (date, time))
+            or not hasattr(connection.ops, 'convert_values')):
+        return value
+    return connection.ops.convert_values(value, field)
+
+
+def date_subquery(date_qs):
+    """
+    Returns a Query for a supplied DateQuerySet that selects the truncated
+    date as DateWithAlias.alias
     """
     # The DateQuerySet gives us a query that we need to clone and hack
     date_q = date_qs.query.clone()
@@ -78,33 +97,390 @@ def date_aggregation(date_qs):
     else:
         date_obj = date_q.select[0]
         date_q.select = [DateWithAlias(date_obj.col, date_obj.lookup_type)]
+    return date_q
+
 
-    # Now use as a subquery to do aggregation
+def date_aggregation(date_qs):
+    """
+    Performs an aggregation for a supplied DateQuerySet
+    """
+    # Use the hacked query as a subquery to do aggregation
     query = DateAggregateQuery(date_qs.model)
-    query.add_subquery(date_q, date_qs.db)
+    query.add_subquery(date_subquery(date_qs), date_qs.db)
     return query.get_counts(date_qs.db)
 
 
-def value_counts(qs, fieldname):
+def date_queryset_field(date_qs):
+    """
+    Returns the model field whose dates a DateQuerySet selects, or None if it
+    isn't known.
+    """
+    field_name = getattr(date_qs, '_field_name', None)
+    if field_name is None:
+        return None
+    return get_model_field(date_qs.model, field_name)[0]
+
+
+def date_aggregation_query(date_qs):
+    """
+    Returns a GroupedCounts that produces the same results as
+    date_aggregation(date_qs)
+    """
+    def convert(connection, rows):
+        return [[convert_date(connection, val), count] for val, count in rows]
+    return GroupedCounts(date_subquery(date_qs), date_qs.db,
+                         DateWithAlias.alias,
+                         'COUNT(%s)' % DateWithAlias.alias,
+                         convert, date_queryset_field(date_qs))
+
+
+class ApproximateCounts(SortedDict):
+    """
+    A SortedDict of {value: count}, with counts scaled up from a sample.
+    """
+
+
+class ApproximateRows(list):
+    """
+    A list of (value, count) rows, with counts scaled up from a sample.
+    """
+
+
+def is_approximate(counts):
+    return isinstance(counts, (ApproximateCounts, ApproximateRows))
+
+
+def can_sample(qs):
+    return qs.model._meta.pk.get_internal_type() in (
+        'AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField',
+        'PositiveIntegerField', 'SmallIntegerField')
+
+
+def sample_queryset(qs, every):
+    """
+    Returns a QuerySet with roughly one in 'every' rows of qs, chosen
+    deterministically by primary key. qs must have an integer primary key.
+    """
+    # TABLESAMPLE would be cheaper where available, but the ORM gives no way
+    # of adding it to the FROM clause.
+    connection = connections[qs.db]
+    opts = qs.model._meta
+    qn = connection.ops.quote_name
+    col = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+    where = connection.ops.combine_expression('%%', [col, '%s']) + ' = 0'
+    return qs.extra(where=[where], params=[every])
+
+
+def scale_counts(counts, factor):
+    """
+    Multiplies the counts (a dictionary of {value: count} or a list of
+    (value, count) rows) by factor, returning ApproximateCounts or
+    ApproximateRows.
+    """
+    if isinstance(counts, dict):
+        return ApproximateCounts([(val, count * factor)
+                                  for val, count in counts.items()])
+    return ApproximateRows([[val, count * factor] for val, count in counts])
+
+
+def total_count(counts):
+    if isinstance(counts, dict):
+        counts = counts.items()
+    return sum(count for val, count in counts)
+
+
+def value_counts(qs, fieldname, limit=None, order_by_count=False):
     """
     Performs a simple query returning the count of each value of
     the field 'fieldname' in the QuerySet, returning the results
-    as a SortedDict of value: count
+    as a SortedDict of value: count, with the count of NULLs (if any) first.
+
+    If limit is given, only the first 'limit' values (plus NULL) are returned,
+    in the order of the values, or with the largest counts first if
+    order_by_count is True.
+    """
+    return value_label_counts(qs, fieldname, (), limit, order_by_count)[0]
+
+
+def value_label_counts(qs, fieldname, label_fieldnames, limit=None,
+                       order_by_count=False):
     """
-    values_counts = qs.filter(**{
-        fieldname+"__isnull": False
-    }).values_list(fieldname)\
+    Like value_counts, but also returns a dictionary of {value: labels}, where
+    labels is the tuple of values of label_fieldnames for that value, fetched
+    in the same query. label_fieldnames must depend only on fieldname (e.g.
+    fields of the model a ForeignKey points to).
+    """
+    # NULLs are a group like any other, so this is a single query.
+    values_counts = qs.values_list(fieldname, *label_fieldnames)\
         .order_by(fieldname)\
-        .annotate(models.Count(fieldname))
+        .annotate(models.Count('pk'))
+    if order_by_count:
+        values_counts = values_counts.order_by('-pk__count', fieldname)
+    if limit is not None:
+        # One more, in case NULL is one of them.
+        values_counts = values_counts[:limit + 1]
+    rows = list(values_counts)
+    values = [(row[0], row[-1]) for row in rows if row[0] is not None]
+    labels = dict((row[0], tuple(row[1:-1])) for row in rows
+                  if row[0] is not None)
+    null_count = sum(row[-1] for row in rows if row[0] is None)
+    if limit is not None and len(values) > limit:
+        values = values[:limit]
+        if not null_count:
+            # NULLs could be in the rows that were left out.
+            null_count = qs.filter(**{fieldname+"__isnull": True}).count()
     count_dict = SortedDict()
-    null_count = qs.filter(**{fieldname+"__isnull": True}).count()
     if null_count:
         count_dict[None] = null_count
-    for val, count in values_counts:
+    for val, count in values:
         count_dict[val] = count
+    return count_dict, labels
+
+
+class ValueWithAlias(object):
+    alias = 'easyfilter_value_alias'
+
+    def __init__(self, col):
+        self.col = col
+
+    def as_sql(self, qn, connection):
+        if isinstance(self.col, (list, tuple)):
+            col = '%s.%s' % tuple([qn(c) for c in self.col])
+        else:
+            col = self.col
+        if VERSION >= (1, 6):
+            return col + ' as ' + self.alias, ()
+        else:
+            return col + ' as ' + self.alias
+
+
+def aliased_values_query(qs, fieldname, alias_class=ValueWithAlias):
+    """
+    Returns a Query selecting the values of fieldname in qs as
+    alias_class.alias, and the field.
+    """
+    if fieldname == 'pk':
+        # get_model_field only knows the real name of the primary key.
+        fieldname = qs.model._meta.pk.name
+    query = qs.values_list(fieldname).order_by().query.clone()
+    if VERSION >= (1, 6):
+        col, field = query.select[0]
+        query.select[0] = alias_class(col), field
+    else:
+        query.select[0] = alias_class(query.select[0])
+        field = get_model_field(qs.model, fieldname)[0]
+    return query, field
+
+
+def value_counts_query(qs, fieldname):
+    """
+    Returns a GroupedCounts that produces the same results as
+    value_counts(qs, fieldname), with NULLs counted in the same statement.
+    """
+    query, field = aliased_values_query(qs, fieldname)
+
+    def convert(connection, rows):
+        count_dict = SortedDict()
+        null_count = sum(count for val, count in rows if val is None)
+        if null_count:
+            count_dict[None] = null_count
+        for val, count in rows:
+            if val is not None:
+                count_dict[convert_value(connection, val, field)] = count
+        return count_dict
+    return GroupedCounts(query, qs.db, ValueWithAlias.alias, 'COUNT(*)',
+                         convert, field)
+
+
+def probe_values_and_bounds(qs, fieldname, limit):
+    """
+    Returns up to 'limit' distinct values of fieldname in qs (including NULL),
+    and the (lowest, highest, row count, non-NULL count) of the field in all of
+    qs, from a single statement.
+    """
+    query, field = aliased_values_query(qs, fieldname)
+    values_sql, params = query.get_compiler(qs.db).as_sql()
+    probe = query.clone()
+    probe.distinct = True
+    probe.set_limits(high=limit)
+    probe_sql, probe_params = probe.get_compiler(qs.db).as_sql()
+    alias = ValueWithAlias.alias
+    # Each branch is tagged, and fills in the columns it needs. The aggregate
+    # comes first, so that the types of the columns come from it rather than
+    # from bare NULLs (which PostgreSQL would take as text).
+    sql = ('SELECT 1, MIN(%s), MAX(%s), COUNT(*), COUNT(%s) '
+           'FROM (%s) easyfilter_values '
+           'UNION ALL '
+           'SELECT 0, %s, NULL, NULL, NULL FROM (%s) easyfilter_probe'
+           % (alias, alias, alias, values_sql, alias, probe_sql))
+    connection = connections[qs.db]
+    cursor = connection.cursor()
+    cursor.execute(sql, tuple(params) + tuple(probe_params))
+    values, bounds = [], None
+    for tag, value, highest, rows, count in cursor.fetchall():
+        if tag == 0:
+            values.append(convert_value(connection, value, field))
+        else:
+            bounds = (convert_value(connection, value, field),
+                      convert_value(connection, highest, field), rows, count)
+    return values, bounds
+
+
+class PkWithAlias(ValueWithAlias):
+    alias = 'easyfilter_pk_alias'
+
+
+def m2m_values_sql(qs, through_fields, exclude=()):
+    """
+    Returns (column, from_sql, params) for a query on the values of a
+    ManyToManyField for the rows of qs. through_fields are the fields of the
+    intermediate table pointing to the model of qs and to the related model.
+
+    The intermediate table is joined to qs, rather than filtered with an
+    'IN (subquery)', and related values in 'exclude' are left out.
+    """
+    fkey_this, fkey_other = through_fields
+    connection = connections[qs.db]
+    qn = connection.ops.quote_name
+    base = aliased_values_query(qs, 'pk', PkWithAlias)[0]
+    # qs can have duplicate rows (e.g. when it is filtered across a
+    # many-to-many relation), which must not be counted more than once.
+    base.distinct = True
+    base_sql, params = base.get_compiler(qs.db).as_sql()
+    column = 'easyfilter_m2m.%s' % qn(fkey_other.column)
+    from_sql = ('FROM %s easyfilter_m2m INNER JOIN (%s) easyfilter_base '
+                'ON easyfilter_m2m.%s = easyfilter_base.%s'
+                % (qn(fkey_this.model._meta.db_table), base_sql,
+                   qn(fkey_this.column), PkWithAlias.alias))
+    params = list(params)
+    if exclude:
+        from_sql += ' WHERE %s NOT IN (%s)' % (
+            column, ', '.join(['%s'] * len(exclude)))
+        params.extend(fkey_other.get_db_prep_value(val, connection)
+                      for val in exclude)
+    return column, from_sql, params
+
+
+def m2m_value_counts(qs, through_fields, exclude=(), limit=None,
+                     order_by_count=False):
+    """
+    Returns a SortedDict of {value: count} for the values of a ManyToManyField
+    for the rows of qs, like value_counts on the intermediate table. See
+    m2m_values_sql for the arguments.
+    """
+    column, from_sql, params = m2m_values_sql(qs, through_fields, exclude)
+    sql = 'SELECT %s, COUNT(*) %s GROUP BY %s ORDER BY %s' % (
+        column, from_sql, column, '2 DESC, 1' if order_by_count else '1')
+    if limit is not None:
+        sql += ' LIMIT %d' % limit
+    connection = connections[qs.db]
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    count_dict = SortedDict()
+    for val, count in cursor.fetchall():
+        count_dict[convert_value(connection, val, through_fields[1])] = count
     return count_dict
 
 
+def m2m_value_counts_query(qs, through_fields, exclude=()):
+    """
+    Returns a GroupedCounts that produces the same results as
+    m2m_value_counts(qs, through_fields, exclude)
+    """
+    column, from_sql, params = m2m_values_sql(qs, through_fields, exclude)
+    sql = 'SELECT %s AS %s %s' % (column, ValueWithAlias.alias, from_sql)
+
+    def convert(connection, rows):
+        return SortedDict((convert_value(connection, val, through_fields[1]),
+                           count) for val, count in rows)
+    return GroupedCounts((sql, params), qs.db, ValueWithAlias.alias,
+                         'COUNT(*)', convert, through_fields[1])
+
+
+def mysql_has_window_functions(server_info):
+    """
+    Returns True if the MySQL server with the version string server_info
+    (like '8.0.21', or '10.3.8-MariaDB' for MariaDB) has window functions.
+    """
+    # MariaDB may prefix its version with '5.5.5-' for old clients.
+    match = re.match(r'(?:5\.5\.5-)?(\d+)\.(\d+)\.(\d+)', server_info)
+    if match is None:
+        return False
+    version = tuple(int(x) for x in match.groups())
+    if 'mariadb' in server_info.lower():
+        return version >= (10, 2)
+    return version >= (8,)
+
+
+def supports_window_functions(connection):
+    vendor = connection.vendor
+    if vendor in ('postgresql', 'oracle'):
+        return True
+    if vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25, 0)
+    if vendor == 'mysql':
+        # mysql_version can't tell MariaDB from MySQL, so use the version
+        # string of the server.
+        if connection.connection is None:
+            connection.cursor().close()
+        return mysql_has_window_functions(
+            connection.connection.get_server_info())
+    return False
+
+
+def ntile_bounds(values, n):
+    """
+    Splits the sorted list values into n groups of sizes differing by at most
+    one, like the NTILE window function, returning the (first, last) value of
+    each.
+    """
+    size, extra = divmod(len(values), n)
+    bounds = []
+    start = 0
+    for i in range(min(n, len(values))):
+        end = start + size + (1 if i < extra else 0)
+        bounds.append((values[start], values[end - 1]))
+        start = end
+    return bounds
+
+
+def quantile_bounds(qs, fieldname, n, sample_every=100):
+    """
+    Splits the non-NULL values of fieldname in qs into n groups with the same
+    number of values, returning the (lowest, highest) value of each group.
+
+    This uses the NTILE window function where the database has it, otherwise
+    the values of a sample of qs (or all values, if the sample is too small to
+    be useful) are sorted in Python.
+    """
+    qs = qs.filter(**{fieldname + '__isnull': False})
+    connection = connections[qs.db]
+    if not supports_window_functions(connection):
+        sample = qs
+        if can_sample(qs):
+            sample = sample_queryset(qs, sample_every)
+        values = list(sample.values_list(fieldname, flat=True)
+                      .order_by(fieldname))
+        if sample is not qs and len(values) < n * 10:
+            values = list(qs.values_list(fieldname, flat=True)
+                          .order_by(fieldname))
+        return ntile_bounds(values, n)
+
+    query, field = aliased_values_query(qs, fieldname)
+    values_sql, params = query.get_compiler(qs.db).as_sql()
+    alias = ValueWithAlias.alias
+    sql = ('SELECT MIN(%s), MAX(%s) FROM ('
+           'SELECT %s, NTILE(%d) OVER (ORDER BY %s) AS easyfilter_tile '
+           'FROM (%s) easyfilter_values) easyfilter_tiles '
+           'GROUP BY easyfilter_tile ORDER BY easyfilter_tile'
+           % (alias, alias, alias, n, alias, values_sql))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [tuple(convert_value(connection, val, field) for val in row)
+            for row in cursor.fetchall()]
+
+
 class NumericAggregateQuery(AggregateQuery):
     # Need to override to return a compiler not in django.db.models.sql.compiler
     def get_compiler(self, using=None, connection=None):
@@ -137,9 +513,16 @@ class NumericAggregateCompiler(SQLCompiler):
 class NumericValueRange(object):
     alias = 'easyfilter_number_range_alias'
 
+    # The quotient used for uniform ranges is scaled down by this much, so
+    # that values on a bound aren't pushed into the next range by rounding
+    # errors of floating point arithmetic.
+    slack = 1 - 1e-10
+
     def __init__(self, col, ranges):
         # ranges is list of (lower, upper) bounds we want to find, where 'lower'
-        # is inclusive and upper is exclusive.
+        # is exclusive and upper is inclusive (except for the first range,
+        # which includes its lower bound). Values that are not in any range
+        # get the index len(ranges).
         self.col = col
         self.ranges = ranges
 
@@ -151,41 +534,269 @@ class NumericValueRange(object):
         else:
             col = self.col
 
-        # Build up case expression.
-        clause = (['CASE '] +
-                  ['WHEN %s > %s AND %s <= %s THEN %s '
-                   % (col, val[0], col, val[1], i)
-                   for i, val in enumerate(self.ranges)] +
-                  # An inclusive lower limit for the first item in ranges:
-                  ['WHEN %s = %s THEN 0 ' % (col, self.ranges[0][0])] +
-                  ['ELSE %s END ' % len(self.ranges)] +
-                  ['as %s' % self.alias])
+        # NULLs get their own bucket, -1.
+        step = uniform_step(self.ranges)
+        if step is not None:
+            sql, params = self.arithmetic_sql(col, step, connection)
+        elif is_sorted_ranges(self.ranges):
+            sql, params = self.search_sql(col, 0, len(self.ranges))
+        else:
+            sql, params = self.linear_sql(col)
+        sql = 'CASE WHEN %s IS NULL THEN -1 ELSE %s END as %s' % (col, sql,
+                                                                  self.alias)
         if VERSION >= (1, 6):
-            return ''.join(clause), ()
+            return sql, tuple(params)
+        else:
+            # No parameters for select columns.
+            return sql % tuple(params)
+
+    def arithmetic_sql(self, col, step, connection):
+        """
+        Computes the index of uniform ranges from the distance to the first
+        lower bound, in constant time per row.
+        """
+        lower, upper = self.ranges[0][0], self.ranges[-1][1]
+        # Multiplying by 1.0 first makes sure this isn't an integer division,
+        # for integer columns (or integral values stored as integers by
+        # SQLite) and integral steps.
+        quotient = '(%s - %%s) * 1.0 / %%s * %%s' % col
+        if connection.vendor == 'sqlite':
+            # No FLOOR, but casting truncates, and the quotient is positive.
+            index = 'CAST(%s AS INTEGER)' % quotient
         else:
-            return ''.join(clause)
+            index = 'FLOOR(%s)' % quotient
+        return ('CASE WHEN %s > %%s AND %s <= %%s THEN %s '
+                'WHEN %s = %%s THEN 0 ELSE %s END'
+                % (col, col, index, col, len(self.ranges)),
+                [lower, upper, lower, step, self.slack, lower])
+
+    def search_sql(self, col, start, end):
+        """
+        Finds the index of sorted ranges with nested CASE expressions, in
+        logarithmic time per row.
+        """
+        if end - start == 1:
+            lower, upper = self.ranges[start][:2]
+            return ('CASE WHEN %s %s %%s AND %s <= %%s THEN %s ELSE %s END'
+                    % (col, '>=' if start == 0 else '>', col, start,
+                       len(self.ranges)),
+                    [lower, upper])
+        mid = (start + end) // 2
+        below_sql, below_params = self.search_sql(col, start, mid)
+        above_sql, above_params = self.search_sql(col, mid, end)
+        return ('CASE WHEN %s <= %%s THEN %s ELSE %s END'
+                % (col, below_sql, above_sql),
+                [self.ranges[mid - 1][1]] + below_params + above_params)
+
+    def linear_sql(self, col):
+        clause = (['CASE '] +
+                  ['WHEN %s > %%s AND %s <= %%s THEN %s ' % (col, col, i)
+                   for i in range(len(self.ranges))] +
+                  # An inclusive lower limit for the first item in ranges:
+                  ['WHEN %s = %%s THEN 0 ' % col] +
+                  ['ELSE %s END' % len(self.ranges)])
+        params = [bound for r in self.ranges for bound in r[:2]]
+        return ''.join(clause), params + [self.ranges[0][0]]
 
 
-def numeric_range_counts(qs, fieldname, ranges):
+def as_decimal(value):
+    if isinstance(value, float):
+        return Decimal(str(value))
+    return Decimal(value)
 
-    # Build the query:
+
+def uniform_step(ranges):
+    """
+    Returns the step of ranges if they are contiguous and have the same
+    width, otherwise None. The step has the type of the bounds, so bounds of
+    mixed types (e.g. an int first and floats after) give None too, rather
+    than a step truncated to the type of one of them.
+    """
+    if len(ranges) < 2:
+        return None
+    if len(set(type(v) for r in ranges for v in r[:2])) > 1:
+        return None
+    bounds = [(as_decimal(r[0]), as_decimal(r[1])) for r in ranges]
+    step = bounds[0][1] - bounds[0][0]
+    if step <= 0:
+        return None
+    for i, (lower, upper) in enumerate(bounds):
+        if upper - lower != step or (i and lower != bounds[i - 1][1]):
+            return None
+    return type(ranges[0][0])(step)
+
+
+def is_sorted_ranges(ranges):
+    """
+    Returns True if ranges are sorted and don't overlap.
+    """
+    return all(r[0] <= r[1] for r in ranges) and all(
+        ranges[i][1] <= ranges[i + 1][0] for i in range(len(ranges) - 1))
+
+
+def numeric_range_subquery(qs, fieldname, ranges):
     query = qs.values_list(fieldname).query.clone()
     if VERSION >= (1, 6):
         col, field = query.select[0]
         query.select[0] = NumericValueRange(col, ranges), field
     else:
         query.select[0] = NumericValueRange(query.select[0], ranges)
+    return query
+
+
+def numeric_range_counts(qs, fieldname, ranges, clamp=True):
+
+    # Build the query:
+    query = numeric_range_subquery(qs, fieldname, ranges)
 
     agg_query = NumericAggregateQuery(qs.model)
     agg_query.add_subquery(query, qs.db)
     results = agg_query.get_counts(qs.db)
+    return range_count_dict(results, ranges, clamp)
 
+
+def numeric_range_counts_query(qs, fieldname, ranges, clamp=True):
+    """
+    Returns a GroupedCounts that produces the same results as
+    numeric_range_counts(qs, fieldname, ranges, clamp)
+    """
+    return GroupedCounts(numeric_range_subquery(qs, fieldname, ranges), qs.db,
+                         NumericValueRange.alias,
+                         'COUNT(%s)' % NumericValueRange.alias,
+                         lambda connection, rows: range_count_dict(rows,
+                                                                   ranges,
+                                                                   clamp),
+                         models.IntegerField())
+
+
+def numeric_histogram(qs, fieldname, bins):
+    """
+    Returns (index, count, distinct values, lowest, highest) rows for the
+    values of fieldname in qs grouped into the ranges in bins, like
+    numeric_range_counts, with the index -1 for NULLs.
+    """
+    query, field = aliased_values_query(qs, fieldname)
+    if VERSION >= (1, 6):
+        col = query.select[0][0].col
+        query.select.append((NumericValueRange(col, bins), field))
+    else:
+        query.select.append(NumericValueRange(query.select[0].col, bins))
+    values_sql, params = query.get_compiler(qs.db).as_sql()
+    value, index = ValueWithAlias.alias, NumericValueRange.alias
+    sql = ('SELECT %s, COUNT(*), COUNT(DISTINCT %s), MIN(%s), MAX(%s) '
+           'FROM (%s) subquery GROUP BY %s ORDER BY %s'
+           % (index, value, value, value, values_sql, index, index))
+    connection = connections[qs.db]
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [(int(i), count, distinct, convert_value(connection, lowest, field),
+             convert_value(connection, highest, field))
+            for i, count, distinct, lowest, highest in cursor.fetchall()]
+
+
+def range_count_dict(results, ranges, clamp=True):
+    """
+    Returns a SortedDict of {range: count} from (range index, count) rows,
+    ordered by index, with the count of NULLs (if any) under the key None.
+    Values outside all ranges are counted in the last one if clamp is True,
+    and left out otherwise.
+    """
     count_dict = SortedDict()
     for val, count in results:
+        if val == -1:
+            count_dict[None] = count
+            continue
         try:
-            r = ranges[val]
+            r = ranges[int(val)]
         except IndexError:
-            # Include in the top range - this could be a rounding error
+            if not clamp:
+                continue
+            # Include in the top range - this could be a rounding error, or a
+            # value above stale cached bounds.
             r = ranges[-1]
-        count_dict[r] = count
+        count_dict[r] = count_dict.get(r, 0) + count
     return count_dict
+
+
+class GroupedCounts(object):
+    """
+    A 'SELECT alias, COUNT(..) FROM (subquery) GROUP BY alias' query, kept in
+    parts so that it can be run on its own or combined with others using
+    combined_counts.
+
+    'convert' is a callable taking a connection and the list of (value, count)
+    rows, and returning the final result. subquery is a Query, or an
+    (sql, params) tuple. 'field' is a model field with the type of the value
+    column, if known.
+    """
+    def __init__(self, subquery, using, alias, count_sql, convert,
+                 field=None):
+        if isinstance(subquery, tuple):
+            self.subquery, self.sub_params = subquery
+        else:
+            agg_query = AggregateQuery(subquery.model)
+            agg_query.add_subquery(subquery, using)
+            self.subquery = agg_query.subquery
+            self.sub_params = agg_query.sub_params
+        self.using = using
+        self.alias = alias
+        self.count_sql = count_sql
+        self.convert = convert
+        self.field = field
+
+    def get_counts(self):
+        return combined_counts([self], self.using)[0]
+
+    def null_sql(self, connection):
+        """
+        Returns a NULL with the type of the value column. PostgreSQL types the
+        bare NULLs of the first branch of a UNION as text, which later
+        branches with other types can't be matched with. MySQL's CAST doesn't
+        take column types, and doesn't need them.
+        """
+        field = self.field
+        if field is None or connection.vendor == 'mysql':
+            return 'NULL'
+        if isinstance(field, models.AutoField):
+            # The column type of an AutoField (e.g. 'serial') isn't a type
+            # that values can be cast to.
+            field = models.IntegerField()
+        db_type = field.db_type(connection)
+        if db_type is None:
+            return 'NULL'
+        return 'CAST(NULL AS %s)' % db_type
+
+
+def combined_counts(grouped_counts, using):
+    """
+    Runs a list of GroupedCounts as a single UNION ALL statement, returning a
+    list of their results in the same order.
+
+    Each GroupedCounts gets its own value column (a NULL of the same type in
+    the rows of the others), so that column types are not mixed, and a tag
+    column to split the rows back up.
+    """
+    if not grouped_counts:
+        return []
+    connection = connections[using]
+    nulls = [gc.null_sql(connection) for gc in grouped_counts]
+    branches, params = [], []
+    for i, gc in enumerate(grouped_counts):
+        columns = list(nulls)
+        columns[i] = gc.alias
+        branches.append('SELECT %d, %s, %s FROM (%s) subquery GROUP BY %s'
+                        % (i, ', '.join(columns), gc.count_sql, gc.subquery,
+                           gc.alias))
+        params.extend(gc.sub_params)
+    # Ordering by every column sorts each tag's rows by its own value column.
+    sql = '%s ORDER BY %s' % (' UNION ALL '.join(branches),
+                              ', '.join(str(i + 1) for i in
+                                        range(len(grouped_counts) + 1)))
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    rows = [[] for gc in grouped_counts]
+    for row in cursor.fetchall():
+        tag = row[0]
+        rows[tag].append((row[tag + 1], row[-1]))
+    return [gc.convert(connection, r) for gc, r in zip(grouped_counts, rows)]
@@ -2,7 +2,8 @@
 Utilities to produce ranges of values for filters
 """
 
-from decimal import Decimal, DecimalTuple, ROUND_HALF_EVEN, ROUND_DOWN, ROUND_UP
+from decimal import Decimal, DecimalTuple, ROUND_HALF_EVEN, ROUND_DOWN, ROUND_UP, \
+    ROUND_FLOOR, ROUND_CEILING
 
 from six.moves import xrange
 
@@ -79,3 +80,75 @@ def auto_ranges(lower, upper, max_items):
             return ranges
 
     assert False, "Can't find a candidate set of ranges, logic error"
+
+
+def round_significant(d, digits, rounding):
+    """
+    Rounds the Decimal d to the number of significant digits.
+    """
+    if d == 0:
+        return d
+    rounded = d.quantize(Decimal(1).scaleb(d.adjusted() - digits + 1),
+                         rounding).normalize()
+    if rounded.as_tuple().exponent > 0:
+        # Avoid things like 1.2E+3
+        rounded = rounded.quantize(1)
+    return rounded
+
+
+def quantile_ranges(bounds, digits=2):
+    """
+    Returns ranges from the (lowest, highest) values of groups of values, as
+    returned by queries.quantile_bounds, with the boundaries rounded to
+    'digits' significant digits. Groups that become empty after rounding are
+    merged.
+    """
+    lower, upper = bounds[0][0], bounds[-1][1]
+    if lower == upper:
+        return [(lower, upper)]
+
+    input_type = type(lower)
+
+    def to_decimal(val):
+        return Decimal(str(val)) if input_type is float else Decimal(val)
+
+    lower_d = round_significant(to_decimal(lower), digits, ROUND_FLOOR)
+    upper_d = round_significant(to_decimal(upper), digits, ROUND_CEILING)
+    boundaries = [lower_d]
+    for _, group_upper in bounds[:-1]:
+        b = round_significant(to_decimal(group_upper), digits, ROUND_HALF_EVEN)
+        if boundaries[-1] < b < upper_d:
+            boundaries.append(b)
+    boundaries.append(upper_d)
+    return [(input_type(boundaries[i]), input_type(boundaries[i + 1]))
+            for i in xrange(len(boundaries) - 1)]
+
+
+def histogram_grid(lower, upper, max_bins):
+    """
+    Returns at most max_bins + 1 uniform ranges covering lower to upper, with
+    a power of ten as their width, so that the boundaries of auto_ranges at
+    this and finer levels are boundaries of the grid.
+    """
+    input_type = type(lower)
+    if input_type is float:
+        lower = str(lower)
+        upper = str(upper)
+    lower_d = Decimal(lower)
+    upper_d = Decimal(upper)
+
+    step = (upper_d - lower_d) / max_bins
+    if step == 0:
+        width = Decimal(1)
+    else:
+        width = Decimal(1).scaleb(step.adjusted())
+        if width < step:
+            width = width.scaleb(1)
+    if input_type is not float and input_type is not Decimal:
+        # No point in splitting integers
+        width = max(width, Decimal(1))
+    start = (lower_d / width).to_integral_value(ROUND_FLOOR) * width
+    num_bins = max(int(((upper_d - start) / width)
+                       .to_integral_value(ROUND_CEILING)), 1)
+    return [(start + width * i, start + width * (i + 1))
+            for i in xrange(num_bins)]
@@ -0,0 +1,159 @@
+"""
+Instrumentation of FilterSets: timing, query and row counts for each filter.
+"""
+from collections import namedtuple
+from timeit import default_timer
+
+from django.db import connections
+from django.dispatch import Signal
+
+# Sent after each instrumented operation, with the FilterSet class as sender.
+filter_timed = Signal(providing_args=['filterset', 'timing'])
+
+# A record of one instrumented operation. 'phase' is one of 'apply_filter',
+# 'prefetch_counts', 'get_choices' or 'render_filter'. filter_class and field
+# are None for operations that aren't specific to a filter.
+FilterTiming = namedtuple('FilterTiming', ['phase', 'filter_class', 'field',
+                                           'elapsed', 'queries', 'rows'])
+
+
+def has_receivers(signal, sender):
+    """
+    Returns True if any receivers are connected to signal for sender.
+    """
+    if hasattr(signal, 'has_listeners'):
+        return signal.has_listeners(sender)
+    # Django < 1.7 doesn't have has_listeners, so count receivers for any
+    # sender.
+    return bool(signal.receivers)
+
+
+class CountingCursor(object):
+    """
+    Wraps a database cursor, counting executed queries and fetched rows.
+    """
+    def __init__(self, cursor, counters):
+        self.cursor = cursor
+        self.counters = counters
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        for row in self.cursor:
+            self._add_rows(1)
+            yield row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        exit = getattr(self.cursor, '__exit__', None)
+        if exit is None:
+            self.cursor.close()
+        else:
+            return exit(*exc_info)
+
+    def _add_rows(self, n):
+        for counter in self.counters:
+            counter.rows += n
+
+    def execute(self, *args, **kwargs):
+        for counter in self.counters:
+            counter.queries += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        for counter in self.counters:
+            counter.queries += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self._add_rows(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self._add_rows(len(rows))
+        return rows
+
+
+class QueryCounter(object):
+    """
+    Context manager that counts the queries run and rows fetched on a
+    database connection of the current thread, and the elapsed time. Can be
+    nested.
+    """
+    def __init__(self, using):
+        self.using = using
+        self.queries = 0
+        self.rows = 0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        connection = connections[self.using]
+        counters = connection.__dict__.setdefault('_easyfilters_counters', [])
+        if not counters:
+            # Shadow the cursor method on this connection object only.
+            self._patched = 'cursor' in connection.__dict__
+            self._cursor = connection.cursor
+            connection.cursor = lambda: CountingCursor(self._cursor(),
+                                                       counters)
+        counters.append(self)
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = default_timer() - self._start
+        connection = connections[self.using]
+        counters = connection._easyfilters_counters
+        counters.remove(self)
+        if not counters:
+            if self._patched:
+                connection.cursor = self._cursor
+            else:
+                del connection.cursor
+
+
+class FilterSetStats(object):
+    """
+    Collects the FilterTiming records for a FilterSet.
+    """
+    def __init__(self):
+        self.timings = []
+
+    def add(self, timing):
+        self.timings.append(timing)
+
+    def for_phase(self, phase):
+        return [t for t in self.timings if t.phase == phase]
+
+    def slowest(self, phase='get_choices'):
+        """
+        Returns the FilterTiming that took longest for the phase, or None.
+        """
+        timings = self.for_phase(phase)
+        if not timings:
+            return None
+        return max(timings, key=lambda t: t.elapsed)
+
+    def summary(self):
+        """
+        Returns a dictionary of {phase: {'elapsed': .., 'queries': ..,
+        'rows': ..}} with the totals for each phase.
+        """
+        result = {}
+        for t in self.timings:
+            totals = result.setdefault(t.phase, {'elapsed': 0.0, 'queries': 0,
+                                                 'rows': 0})
+            totals['elapsed'] += t.elapsed
+            totals['queries'] += t.queries
+            totals['rows'] += t.rows
+        return result
@@ -1,3 +1,7 @@
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
 try:
     from django.db.models.constants import LOOKUP_SEP
 except ImportError:  # Django < 1.5 fallback
@@ -23,7 +27,36 @@ def python_2_unicode_compatible(klass):  # Copied from Django 1.5
     return klass
 
 
+def get_model_path(model, f):
+    """
+    Returns the list of models that the lookup path f goes through, starting
+    with model.
+    """
+    parts = f.split(LOOKUP_SEP)
+    opts = model._meta
+    models = [model]
+    for name in parts[:-1]:
+        rel = opts.get_field_by_name(name)[0]
+        if isinstance(rel, RelatedObject):
+            model = rel.model
+            opts = rel.opts
+        else:
+            model = rel.rel.to
+            opts = model._meta
+        models.append(model)
+    return models
+
+
+# Results of get_model_field, which only depend on the model definitions.
+_model_fields = {}
+
+
 def get_model_field(model, f):
+    key = (model, f)
+    try:
+        return _model_fields[key]
+    except KeyError:
+        pass
     parts = f.split(LOOKUP_SEP)
     opts = model._meta
     for name in parts[:-1]:
@@ -35,4 +68,154 @@ def get_model_field(model, f):
             model = rel.rel.to
             opts = model._meta
     rel, model, direct, m2m = opts.get_field_by_name(parts[-1])
+    _model_fields[key] = (rel, m2m)
     return rel, m2m
+
+
+def call_in_worker_thread(func, *args):
+    """
+    Calls func(*args) in a worker thread, then closes the database connections
+    of the thread that are unusable or older than their CONN_MAX_AGE, as
+    Django does at the end of a request, so that the others can be reused by
+    the next task of the thread. On Django < 1.6, which has no persistent
+    connections, they are all closed.
+    """
+    from django.db import connections
+    try:
+        return func(*args)
+    finally:
+        for connection in connections.all():
+            if hasattr(connection, 'close_if_unusable_or_obsolete'):
+                connection.close_if_unusable_or_obsolete()
+            else:
+                connection.close()
+
+
+# (process id, pool) of the pool used by get_thread_pool
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+
+def get_thread_pool():
+    """
+    Returns the pool of threads shared by all FilterSets in this process, with
+    the number of threads given by the EASYFILTERS_MAX_WORKERS setting (4 by
+    default), so that the number of threads and database connections doesn't
+    grow with the number of concurrent requests.
+    """
+    global _thread_pool
+    from django.conf import settings
+    with _thread_pool_lock:
+        # Threads don't survive a fork, so child processes need a new pool.
+        if _thread_pool is None or _thread_pool[0] != os.getpid():
+            size = getattr(settings, 'EASYFILTERS_MAX_WORKERS', 4)
+            _thread_pool = os.getpid(), ThreadPool(size)
+        return _thread_pool[1]
+
+
+def can_use_other_connections(using):
+    """
+    Returns False if queries for the database 'using' must be run in the
+    current thread, because connections in other threads would not see the
+    same data.
+    """
+    from django.db import connections
+    from django.db import transaction
+    connection = connections[using]
+    if hasattr(connection, 'in_atomic_block'):
+        if connection.in_atomic_block:
+            return False
+    elif transaction.is_managed(using=using):  # Django < 1.6
+        return False
+    if connection.vendor == 'sqlite':
+        name = connection.settings_dict['NAME']
+        if not name or name == ':memory:' or 'mode=memory' in name:
+            return False
+    return True
+
+
+def max_query_params(using):
+    """
+    Returns the maximum number of parameters in a query for the database
+    'using', or None if there is no (small) limit.
+    """
+    from django.db import connections
+    connection = connections[using]
+    limit = getattr(connection.features, 'max_query_params', None)
+    if limit is None and connection.vendor == 'sqlite':
+        limit = 999
+    return limit
+
+
+def in_chunk_size(using):
+    """
+    Returns the number of values that can be used in an __in lookup for the
+    database 'using', or None if there is no limit.
+    """
+    limit = max_query_params(using)
+    # Leave some room for other parameters.
+    return None if limit is None else max(1, limit - 100)
+
+
+def filter_in_chunks(qs, field_name, values, chunk_size=None):
+    """
+    Returns a list of the objects of qs whose field_name is one of the values,
+    using a query for every chunk_size values (by default, as many as the
+    database allows). Objects are only ordered within each chunk.
+    """
+    values = list(values)
+    if chunk_size is None:
+        chunk_size = in_chunk_size(qs.db) or max(1, len(values))
+    objs = []
+    for i in range(0, len(values), chunk_size):
+        objs.extend(qs.filter(**{field_name + '__in':
+                                 values[i:i + chunk_size]}))
+    return objs
+
+
+def run_in_executor(using, func, *args):
+    """
+    Runs func(*args) in the default executor of the asyncio event loop, with
+    its own database connection, returning an awaitable asyncio Future. If
+    that can't be done for the database 'using', func is called immediately.
+    """
+    import asyncio
+    if not can_use_other_connections(using):
+        return completed_future(func, *args)
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, call_in_worker_thread, func, *args)
+
+
+def completed_future(func, *args):
+    """
+    Calls func(*args) now, returning an asyncio Future with the result.
+    """
+    import asyncio
+    future = asyncio.Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def chain_future(future, func):
+    """
+    Returns an asyncio Future for the result of calling func with the result
+    of future, once that is done.
+    """
+    import asyncio
+    chained = asyncio.Future()
+
+    def done(f):
+        if f.cancelled():
+            chained.cancel()
+        elif f.exception() is not None:
+            chained.set_exception(f.exception())
+        else:
+            try:
+                chained.set_result(func(f.result()))
+            except Exception as e:
+                chained.set_exception(e)
+    future.add_done_callback(done)
+    return chained
@@ -0,0 +1,240 @@
+"""
+Performance benchmarks for FilterSets, using a synthetic catalog of books.
+
+Run with the easyfilters_benchmark management command, e.g.:
+
+    django-admin.py easyfilters_benchmark --sizes=10000,100000 \\
+        --output=results.json --baseline=baseline.json
+"""
+import platform
+import random
+from bisect import bisect
+from datetime import date
+from datetime import timedelta
+from decimal import Decimal
+from timeit import default_timer
+
+import django
+from django.core.management.color import no_style
+from django.db import connections
+from django.db import reset_queries
+from django.db import transaction
+from django.http import QueryDict
+
+from django_easyfilters import FilterSet
+from django_easyfilters.filters import NumericRangeFilter
+
+from .models import BINDING_CHOICES
+from .models import Author
+from .models import Book
+from .models import Genre
+
+# Rows are inserted in chunks small enough for SQLite's limit on the number of
+# query parameters.
+CHUNK_SIZE = 100
+
+GENRES = 50
+
+FIELDS = [
+    'genre',
+    'binding',
+    'authors',
+    'date_published',
+    'price',
+    'rating',
+    'edition',
+    ('genre__likes', {}, NumericRangeFilter),
+]
+
+# Query strings for the FilterSets that are timed. Genre 1 and author 1 are the
+# most popular ones in generated catalogs.
+SCENARIOS = [
+    ('all', ''),
+    ('genre', 'genre=1'),
+    ('author+decade', 'authors=1&date_published=1990..1999'),
+    ('price', 'price=10..20i'),
+]
+
+
+class BookFilterSet(FilterSet):
+    fields = FIELDS
+    # For the query and row counts in the results.
+    collect_stats = True
+
+
+def zipf_sampler(rng, n, s=1.1):
+    """
+    Returns a function giving random numbers in range(n), with a Zipfian
+    distribution of exponent s.
+    """
+    total = 0.0
+    cumulative = []
+    for k in range(1, n + 1):
+        total += 1.0 / k ** s
+        cumulative.append(total)
+    return lambda: min(bisect(cumulative, rng.random() * total), n - 1)
+
+
+def atomic(using):
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic(using=using)
+    return transaction.commit_on_success(using=using)
+
+
+def bulk_create(model, objs, using):
+    for i in range(0, len(objs), CHUNK_SIZE):
+        model.objects.using(using).bulk_create(objs[i:i + CHUNK_SIZE])
+
+
+def generate_catalog(size, seed=0, using='default'):
+    """
+    Replaces all Books, Authors and Genres with a deterministic catalog of
+    'size' books, with skewed distributions:
+
+    * genres are Zipfian, and 2% of books have no genre
+    * the number of authors per book is long-tailed (mostly 1, up to 20), and
+      authors are Zipfian
+    * date_published spans 1900-2015, with more recent books, and 5% NULLs
+    * rating is NULL for 60% of books
+
+    Primary keys are set explicitly (starting at 1), and the database
+    sequences are reset afterwards.
+    """
+    rng = random.Random(seed)
+    with atomic(using):
+        Book.authors.through.objects.using(using).all().delete()
+        Book.objects.using(using).all().delete()
+        Author.objects.using(using).all().delete()
+        Genre.objects.using(using).all().delete()
+
+        bulk_create(Genre, [Genre(pk=i, name='Genre %d' % i,
+                                  likes=rng.randint(0, 1000))
+                            for i in range(1, GENRES + 1)], using)
+        num_authors = max(100, size // 20)
+        bulk_create(Author, [Author(pk=i, name='Author %d' % i,
+                                    likes=rng.randint(0, 1000))
+                             for i in range(1, num_authors + 1)], using)
+
+        random_genre = zipf_sampler(rng, GENRES)
+        random_author = zipf_sampler(rng, num_authors)
+        bindings = [b for b, _ in BINDING_CHOICES] + [None]
+        first_day = date(1900, 1, 1)
+        days = (date(2015, 12, 31) - first_day).days
+        through = Book.authors.through
+        for start in range(0, size, CHUNK_SIZE):
+            books = []
+            links = []
+            for i in range(start + 1, min(start + CHUNK_SIZE, size) + 1):
+                books.append(Book(
+                    pk=i,
+                    name='Book %d' % i,
+                    binding=rng.choice(bindings),
+                    genre_id=(None if rng.random() < 0.02
+                              else random_genre() + 1),
+                    price=Decimal(int(rng.lognormvariate(2.5, 0.6) * 100)) / 100,
+                    date_published=(None if rng.random() < 0.05 else
+                                    first_day + timedelta(
+                                        days=int(days * rng.random() ** 0.5))),
+                    edition=min(int(rng.paretovariate(3.0)), 10),
+                    rating=(None if rng.random() < 0.6
+                            else round(rng.uniform(1, 5), 1)),
+                ))
+                count = min(int(rng.paretovariate(1.5)), 20)
+                if rng.random() < 0.05:
+                    count = 0
+                for author_id in sorted(set(random_author() + 1
+                                            for _ in range(count))):
+                    links.append(through(book_id=i, author_id=author_id))
+            Book.objects.using(using).bulk_create(books)
+            bulk_create(through, links, using)
+            # Don't keep all the queries around when DEBUG is on.
+            reset_queries()
+
+        # Explicit primary keys don't advance the sequences, so later inserts
+        # would reuse them.
+        connection = connections[using]
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                     [Genre, Author, Book]):
+            cursor.execute(sql)
+
+
+def timed(func, repeat):
+    """
+    Calls func repeat times, returning the min and median times, and the
+    result of the last call.
+    """
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        result = func()
+        times.append(default_timer() - start)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2]}, result
+
+
+def run_benchmarks(size, repeat=5, using='default', filterset_class=BookFilterSet):
+    """
+    Times FilterSet construction, get_choices for each filter and render, for
+    each of the SCENARIOS. Returns a list of result dictionaries.
+    """
+    qs = Book.objects.using(using).all()
+    results = []
+
+    def add(scenario, name, timing, fs):
+        summary = fs.stats.summary().get('get_choices', {})
+        timing.update(size=size, scenario=scenario, name=name,
+                      queries=summary.get('queries', 0),
+                      rows=summary.get('rows', 0))
+        results.append(timing)
+
+    for scenario, query in SCENARIOS:
+        params = QueryDict(query)
+
+        def construct():
+            return filterset_class(qs, params)
+
+        def get_choices(field):
+            fs = filterset_class(qs, params)
+            fs.get_filter_choices(field)
+            return fs
+
+        def render():
+            fs = filterset_class(qs, params)
+            fs.render()
+            return fs
+
+        add(scenario, 'construct', *timed(construct, repeat))
+        for filter_ in construct().filters:
+            add(scenario,
+                'get_choices:%s:%s' % (type(filter_).__name__, filter_.field),
+                *timed(lambda: get_choices(filter_.field), repeat))
+        add(scenario, 'render', *timed(render, repeat))
+    return results
+
+
+def environment(using='default'):
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connections[using].vendor,
+    }
+
+
+def compare_results(results, baseline, threshold=1.2):
+    """
+    Compares results with baseline results, returning a list of (result,
+    baseline result, ratio) for the benchmarks that are slower than baseline
+    by more than threshold, using the min timings.
+    """
+    by_key = dict(((r['size'], r['scenario'], r['name']), r)
+                  for r in baseline)
+    regressions = []
+    for r in results:
+        base = by_key.get((r['size'], r['scenario'], r['name']))
+        if base is None or not base['min']:
+            continue
+        ratio = r['min'] / base['min']
+        if ratio > threshold:
+            regressions.append((r, base, ratio))
+    return regressions
@@ -0,0 +1,73 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from test_app.benchmarks import compare_results
+from test_app.benchmarks import environment
+from test_app.benchmarks import generate_catalog
+from test_app.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ("Times FilterSets on generated catalogs of books. "
+            "This replaces all Books, Authors and Genres in the database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='10000',
+                    help="Comma separated numbers of books (default: 10000)."),
+        make_option('--seed', type='int', default=0,
+                    help="Seed for the data generator (default: 0)."),
+        make_option('--repeat', type='int', default=5,
+                    help="Number of times each benchmark is run (default: 5)."),
+        make_option('--database', default='default',
+                    help="Database to use (default: 'default')."),
+        make_option('--reuse-data', action='store_true', default=False,
+                    help="Don't generate data, use the existing books. Only "
+                         "a single size can be given."),
+        make_option('--output',
+                    help="File to write the results to, as JSON."),
+        make_option('--baseline',
+                    help="JSON file with results of a previous run, to "
+                         "compare with."),
+        make_option('--threshold', type='float', default=1.2,
+                    help="Slowdown ratio (of min timings) above which a "
+                         "benchmark is a regression (default: 1.2)."),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        if options['reuse_data'] and len(sizes) > 1:
+            raise CommandError("--reuse-data needs a single size.")
+        using = options['database']
+        results = []
+        for size in sizes:
+            if not options['reuse_data']:
+                self.stdout.write("Generating %d books\n" % size)
+                generate_catalog(size, options['seed'], using)
+            self.stdout.write("Running benchmarks for %d books\n" % size)
+            for r in run_benchmarks(size, options['repeat'], using):
+                self.stdout.write("%(scenario)15s %(name)-45s %(min)9.4fs "
+                                  "%(median)9.4fs %(queries)3d queries\n" % r)
+                results.append(r)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'environment': environment(using),
+                           'seed': options['seed'],
+                           'results': results}, f, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+            regressions = compare_results(results, baseline,
+                                          options['threshold'])
+            for r, base, ratio in regressions:
+                self.stdout.write("Regression: %s %s %s: %.4fs -> %.4fs "
+                                  "(x%.2f)\n" % (r['size'], r['scenario'],
+                                                 r['name'], base['min'],
+                                                 r['min'], ratio))
+            if regressions:
+                raise CommandError("%d benchmarks are slower than the "
+                                   "baseline." % len(regressions))
@@ -57,3 +57,4 @@ class Book(models.Model):
 class Person(models.Model):
     date_of_birth = models.DateField()
     name = models.CharField(max_length=50)
+    friends = models.ManyToManyField('self', blank=True)
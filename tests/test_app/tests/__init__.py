@@ -1,2 +1,3 @@
-from .test_filterset import *
-from .test_ranges import *
\ No newline at end of file
+from .test_filterset import *
+from .test_ranges import *
+from .test_benchmarks import *
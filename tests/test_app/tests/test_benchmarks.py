@@ -0,0 +1,45 @@
+from django.test import TestCase
+
+from test_app.benchmarks import compare_results
+from test_app.benchmarks import generate_catalog
+from test_app.benchmarks import run_benchmarks
+from test_app.benchmarks import SCENARIOS
+from test_app.models import Author, Book, Genre
+
+
+class TestBenchmarks(TestCase):
+
+    def test_generate_catalog(self):
+        generate_catalog(300, seed=1)
+        self.assertEqual(Book.objects.count(), 300)
+        self.assertEqual(Author.objects.count(), 100)
+        self.assertEqual(Genre.objects.count(), 50)
+        # Skewed distributions, with NULLs
+        popular = Genre.objects.get(name='Genre 1')
+        rare = Genre.objects.get(name='Genre 50')
+        self.assertTrue(Book.objects.filter(genre=popular).count() >
+                        Book.objects.filter(genre=rare).count())
+        self.assertTrue(Book.objects.filter(rating=None).count() > 100)
+        # New rows don't collide with the generated primary keys.
+        self.assertTrue(Genre.objects.create(name='New').pk > 50)
+        first = list(Book.objects.values_list('genre', 'price', 'date_published',
+                                              'authors').order_by('pk', 'authors'))
+
+        # Deterministic
+        generate_catalog(300, seed=1)
+        self.assertEqual(first,
+                         list(Book.objects.values_list('genre', 'price', 'date_published',
+                                                       'authors').order_by('pk', 'authors')))
+
+    def test_run_benchmarks(self):
+        generate_catalog(100)
+        results = run_benchmarks(100, repeat=1)
+        self.assertEqual(set(r['scenario'] for r in results),
+                         set(s for s, _ in SCENARIOS))
+        render = [r for r in results if r['name'] == 'render']
+        self.assertEqual(len(render), len(SCENARIOS))
+        self.assertTrue(all(r['queries'] > 0 for r in render))
+
+        slower = [dict(r, min=r['min'] * 2 + 1) for r in results]
+        self.assertEqual(compare_results(results, results), [])
+        self.assertEqual(len(compare_results(slower, results)), len(results))
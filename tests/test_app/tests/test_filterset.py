@@ -1,19 +1,37 @@
 # -*- coding: utf-8; -*-
 
 from datetime import datetime, date
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 import operator
 import re
-
+import threading
+import unittest
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from django.db import connections
+from django.db.models import IntegerField
 from django.http import QueryDict
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.utils.datastructures import MultiValueDict
 from six import text_type
 
+from django_easyfilters.cache import get_cache, related_objects, date_histograms
 from django_easyfilters.filterset import FilterSet
+from django_easyfilters.queries import numeric_range_counts, uniform_step, numeric_histogram, \
+    quantile_bounds, ntile_bounds, aliased_values_query, combined_counts, value_counts_query, \
+    date_aggregation_query, numeric_range_counts_query, mysql_has_window_functions
+from django_easyfilters.cache import range_boundaries, field_bounds, \
+    numeric_histograms
+from django_easyfilters.stats import filter_timed
+from django_easyfilters.utils import filter_in_chunks, get_thread_pool
+from django_easyfilters.ranges import histogram_grid
 from django_easyfilters.filters import \
     FILTER_ADD, FILTER_REMOVE, FILTER_DISPLAY, \
-    ForeignKeyFilter, ValuesFilter, ChoicesFilter, ManyToManyFilter, DateTimeFilter, NumericRangeFilter
+    ForeignKeyFilter, ValuesFilter, ChoicesFilter, ManyToManyFilter, DateTimeFilter, NumericRangeFilter, \
+    DateChoice, MONTH, RangeEnd
 
 from test_app.models import Book, Genre, Author, BINDING_CHOICES, Person
 
@@ -84,6 +102,36 @@ class TestFilterSet(TestCase):
         self.assertTrue('Bogus template from file for testing' in rendered)
         self.assertEqual(rendered, text_type(fs))
 
+    def test_custom_field_template(self):
+        class BookFilterSet(FilterSet):
+            field_templates = {
+                'binding': "template_for_tests.html",
+                }
+            fields = [
+                'genre',
+                'binding',
+                ]
+
+        qs = Book.objects.all()
+        fs = BookFilterSet(qs, QueryDict(''))
+        rendered_genre = fs.render_filter(fs.get_filter('genre'))
+        rendered_binding = fs.render_filter(fs.get_filter('binding'))
+        self.assertTrue('Genre' in rendered_genre)
+        self.assertTrue('Bogus template from file for testing' in rendered_binding)
+
+    def test_template_compiled_once(self):
+        class BookFilterSet(FilterSet):
+            template = u"Template compiled once"
+            fields = [
+                'genre',
+                'binding',
+                ]
+
+        qs = Book.objects.all()
+        fs1 = BookFilterSet(qs, QueryDict(''))
+        fs2 = BookFilterSet(qs, QueryDict(''))
+        self.assertTrue(fs1.get_template('genre') is fs2.get_template('binding'))
+
 
     def test_get_filter_for_field(self):
         """
@@ -109,6 +157,23 @@ class TestFilterSet(TestCase):
         self.assertEqual(NumericRangeFilter, type(fs.filters[5]))
         self.assertEqual(NumericRangeFilter, type(fs.filters[6]))
 
+    def test_filter_specs_reused(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                ('price', dict(max_links=3)),
+                ]
+
+        fs1 = BookFilterSet(Book.objects.all(), QueryDict(''))
+        fs2 = BookFilterSet(Book.objects.all(), QueryDict('price=3.50..4.00'))
+        specs = fs1.get_filter_specs()
+        self.assertEqual(specs, fs2.get_filter_specs())
+        # The cached options can't be changed through the returned copies.
+        specs[1][2]['max_links'] = 5
+        self.assertEqual(fs2.get_filter_specs()[1][2], dict(max_links=3))
+        self.assertTrue(fs1.filters[1].choice_type is fs2.filters[1].choice_type)
+        self.assertEqual(fs2.filters[1].max_links, 3)
+
     def test_specify_custom_filter(self):
         class AuthorFilterSet(FilterSet):
             fields = [
@@ -147,6 +212,347 @@ class TestFilterSet(TestCase):
         f = BookFilterSet(qs, data)
         self.assertEqual(f.title, "Classics")
 
+    def test_lazy_choices(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                'date_published',
+                ]
+            title_fields = [
+                'genre',
+                ]
+
+        qs = Book.objects.all()
+        fs = BookFilterSet(qs, QueryDict('genre=6'))
+        with self.assertNumQueries(0):
+            # Only a 'remove' choice for genre is needed
+            self.assertEqual(fs.title, "Classics")
+        with self.assertNumQueries(1):
+            # 1 query for the binding counts, none for the other filters
+            fs.render_filter(fs.get_filter('binding'))
+
+    def test_combine_queries(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'binding',
+                'edition',
+                'authors',
+                'date_published',
+                ('price', dict(ranges=[(Decimal('1.00'), Decimal('5.00')),
+                                       (Decimal('5.00'), Decimal('100.00'))])),
+                ]
+
+        class CombinedBookFilterSet(BookFilterSet):
+            combine_queries = True
+
+        qs = Book.objects.all()
+        data = QueryDict('date_published=1818')
+        fs = BookFilterSet(qs, data)
+        fs_combined = CombinedBookFilterSet(qs, data)
+        with self.assertNumQueries(4):
+            # 1 query for the counts of binding, edition, authors, the months
+            #   of 1818 and the price ranges
+            # 1 query for the authors objects
+            # 1 query to choose between values/ranges for price, and 1 for the
+            #   value counts, since there are only a few prices in 1818
+            fs_combined.render()
+        for f in fs.filters:
+            self.assertEqual(fs.get_filter_choices(f.field),
+                             fs_combined.get_filter_choices(f.field))
+
+    def test_combine_queries_types(self):
+        """
+        Tests that the value columns of combined counts have the same type in
+        every branch of the UNION, which some databases (e.g. PostgreSQL)
+        need.
+        """
+        qs = Book.objects.all()
+        queries = [value_counts_query(qs, 'genre'),
+                   value_counts_query(qs, 'binding'),
+                   date_aggregation_query(qs.dates('date_published', 'year')),
+                   numeric_range_counts_query(qs, 'price', [(0, 5), (5, 10)])]
+        connection = connections[qs.db]
+        fields = [IntegerField(), Book._meta.get_field('binding'),
+                  Book._meta.get_field('date_published'), IntegerField()]
+        self.assertEqual([gc.null_sql(connection) for gc in queries],
+                         ['CAST(NULL AS %s)' % f.db_type(connection) for f in fields])
+        self.assertEqual(combined_counts(queries, qs.db),
+                         [gc.get_counts() for gc in queries])
+
+    def test_approximate(self):
+        class BookFilterSet(FilterSet):
+            defaults = dict(approximate=True, sample_every=2,
+                            approximate_threshold=2)
+            fields = [
+                'genre',
+                'authors',
+                'date_published',
+                'edition',
+                ]
+
+        qs = Book.objects.all()
+        fs = BookFilterSet(qs, QueryDict(''))
+        sample = [b for b in qs if b.id % 2 == 0]
+        self.assertTrue(len(sample) > 0)
+        for field in ['genre', 'authors', 'date_published', 'edition']:
+            choices = fs.get_filter_choices(field)
+            self.assertTrue(all(c.approximate for c in choices
+                                if c.link_type == FILTER_ADD), field)
+        genre_counts = dict((c.label, c.count) for c in fs.get_filter_choices('genre')
+                            if c.link_type == FILTER_ADD and c.label != '(null)')
+        for genre in Genre.objects.filter(book__in=sample).distinct():
+            self.assertEqual(genre_counts[text_type(genre)],
+                             2 * len([b for b in sample if b.genre_id == genre.id]))
+        self.assertTrue('~' in fs.render_filter(fs.get_filter('genre')))
+
+        # Exact counts for small QuerySets
+        class SmallBookFilterSet(BookFilterSet):
+            defaults = dict(approximate=True, sample_every=2)
+
+        class ExactBookFilterSet(BookFilterSet):
+            defaults = None
+
+        fs_small = SmallBookFilterSet(qs, QueryDict(''))
+        fs_exact = ExactBookFilterSet(qs, QueryDict(''))
+        for field in ['genre', 'authors', 'date_published', 'edition']:
+            self.assertEqual(fs_small.get_filter_choices(field),
+                             fs_exact.get_filter_choices(field))
+
+    def test_max_choices(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                ('genre', dict(max_choices=2, order_by_count=True)),
+                ('edition', dict(max_choices=1)),
+                ('binding', dict(max_choices=10)),
+                ]
+
+        qs = Book.objects.all()
+        fs = BookFilterSet(qs, QueryDict(''))
+        # Ties are broken by the ordering of values
+        genres = sorted(Genre.objects.all(), key=lambda g: (-g.book_set.count(), g.name))
+        self.assertTrue(len(genres) > 2)
+        choices = fs.get_filter_choices('genre')
+        self.assertTrue(choices.has_more)
+        self.assertEqual(sorted((c.label, c.count) for c in choices if c.label != '(null)'),
+                         sorted((text_type(g), g.book_set.count()) for g in genres[:2]))
+
+        editions = sorted(set(qs.exclude(edition=None).values_list('edition', flat=True)))
+        choices = fs.get_filter_choices('edition')
+        self.assertTrue(choices.has_more)
+        self.assertEqual([c.label for c in choices if c.label != '(null)'],
+                         [text_type(editions[0])])
+
+        self.assertFalse(fs.get_filter_choices('binding').has_more)
+        self.assertTrue('&hellip;' in fs.render_filter(fs.get_filter('genre')))
+
+    def test_cache_related(self):
+        class BookFilterSet(FilterSet):
+            defaults = dict(cache_related=True)
+            fields = [
+                'genre',
+                'authors',
+                ]
+
+        related_objects.clear()
+        self.addCleanup(related_objects.clear)
+        qs = Book.objects.all()
+        authors = list(Author.objects.all()[:2])
+        data = QueryDict('genre=6&authors=%d&authors=%d' % (authors[0].pk, authors[1].pk))
+        with self.assertNumQueries(2):
+            # 1 query for each filter
+            fs = BookFilterSet(qs, data)
+        with self.assertNumQueries(0):
+            fs2 = BookFilterSet(qs, data)
+        self.assertEqual(fs.filters[0].chosen, fs2.filters[0].chosen)
+        self.assertEqual(fs.filters[1].chosen, tuple(authors))
+
+        genre = Genre.objects.get(pk=6)
+        genre.name = 'Old classics'
+        genre.save()
+        with self.assertNumQueries(1):
+            fs3 = BookFilterSet(qs, data)
+        self.assertEqual(text_type(fs3.filters[0].chosen[0]), 'Old classics')
+
+        # Changes without signals are picked up when entries expire.
+        Genre.objects.filter(pk=6).update(name='Classics')
+        self.assertEqual(text_type(BookFilterSet(qs, data).filters[0].chosen[0]),
+                         'Old classics')
+        with self.settings(EASYFILTERS_RELATED_CACHE_TIMEOUT=0):
+            related_objects.clear()
+            BookFilterSet(qs, data)
+            with self.assertNumQueries(2):
+                fs4 = BookFilterSet(qs, data)
+        self.assertEqual(text_type(fs4.filters[0].chosen[0]), 'Classics')
+
+    def test_stats(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'binding',
+                'authors',
+                ]
+
+        timings = []
+
+        def receiver(sender, filterset, timing, **kwargs):
+            timings.append(timing)
+
+        filter_timed.connect(receiver, sender=BookFilterSet)
+        try:
+            fs = BookFilterSet(Book.objects.all(), QueryDict('binding=H'))
+            with self.assertNumQueries(2):
+                fs.render()
+        finally:
+            filter_timed.disconnect(receiver, sender=BookFilterSet)
+
+        self.assertEqual(timings, fs.stats.timings)
+        applied = fs.stats.for_phase('apply_filter')
+        self.assertEqual([(t.filter_class, t.field, t.queries) for t in applied],
+                         [(ChoicesFilter, 'binding', 0),
+                          (ManyToManyFilter, 'authors', 0)])
+        choices = fs.stats.for_phase('get_choices')
+        self.assertEqual([(t.field, t.queries) for t in choices],
+                         [('binding', 0), ('authors', 2)])
+        self.assertTrue(choices[1].rows >= len(fs.get_filter_choices('authors')))
+        # Choices are all loaded before rendering.
+        summary = fs.stats.summary()
+        self.assertEqual(summary['get_choices']['queries'], 2)
+        self.assertEqual(summary['render_filter']['queries'], 0)
+        self.assertEqual(fs.stats.slowest('render_filter').phase, 'render_filter')
+
+        # Without receivers, stats are only collected if asked for.
+        fs = BookFilterSet(Book.objects.all(), QueryDict('binding=H'))
+        fs.render()
+        self.assertEqual(fs.stats.timings, [])
+
+        class StatsBookFilterSet(BookFilterSet):
+            collect_stats = True
+
+        fs = StatsBookFilterSet(Book.objects.all(), QueryDict('binding=H'))
+        fs.render()
+        self.assertEqual(fs.stats.summary()['get_choices']['queries'], 2)
+
+    def test_concurrent_queries(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                ]
+
+        class ConcurrentBookFilterSet(BookFilterSet):
+            concurrent_queries = True
+
+        qs = Book.objects.all()
+        fs = ConcurrentBookFilterSet(qs, QueryDict(''))
+        # Tests run inside a transaction, which other connections can't see.
+        self.assertFalse(fs.can_run_concurrently())
+        self.assertEqual(fs.render(), BookFilterSet(qs, QueryDict('')).render())
+
+    @unittest.skipIf(asyncio is None, "asyncio is not available")
+    def test_async_api(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                ]
+
+        qs = Book.objects.all()
+        data = QueryDict('genre=6')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            fs = loop.run_until_complete(BookFilterSet.acreate(qs, data))
+            self.assertEqual(loop.run_until_complete(fs.arender()),
+                             BookFilterSet(qs, data).render())
+            self.assertEqual(loop.run_until_complete(fs.atitle()), "Classics")
+            self.assertEqual(loop.run_until_complete(fs.filters[1].aget_choices(fs.qs)),
+                             fs.get_filter_choices('binding'))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_cache(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                ]
+            cache_alias = 'default'
+
+        get_cache('default').clear()
+        qs = Book.objects.all()
+        rendered = BookFilterSet(qs, QueryDict('binding=H&other=x')).render()
+
+        # Order of params doesn't matter
+        fs = BookFilterSet(qs, QueryDict('other=x&binding=H'))
+        with self.assertNumQueries(0):
+            self.assertEqual(rendered, fs.render())
+
+        # Changes to related models make the cache stale
+        genre = Book.objects.filter(binding='H', genre__isnull=False)[0].genre
+        genre.name = 'Renamed genre'
+        genre.save()
+        fs = BookFilterSet(qs, QueryDict('binding=H&other=x'))
+        self.assertTrue('Renamed' in fs.render())
+
+        # So do changes to the models joined by other filters
+        class UncachedBookFilterSet(BookFilterSet):
+            cache_alias = None
+
+        author = Author.objects.get(name=u'Anne Brontë')
+        params = QueryDict('authors=%s' % author.pk)
+
+        def binding_choices(klass):
+            return [(c.label, c.count) for c in
+                    klass(qs, params).get_filter_choices('binding')]
+        before = binding_choices(BookFilterSet)
+        other_book = Book.objects.exclude(authors=author).exclude(binding__isnull=True)[0]
+        other_book.authors.add(author)
+        after = binding_choices(BookFilterSet)
+        self.assertNotEqual(before, after)
+        self.assertEqual(after, binding_choices(UncachedBookFilterSet))
+
+class TestConcurrentQueries(TransactionTestCase):
+    # Not inside a transaction, so that other threads see the data.
+    fixtures = ['django_easyfilters_tests']
+
+    def test_concurrent_queries(self):
+        threads = []
+
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'binding',
+                'authors',
+                ]
+
+            def get_choices(self, filter_):
+                threads.append(threading.current_thread())
+                return super(BookFilterSet, self).get_choices(filter_)
+
+        class ConcurrentBookFilterSet(BookFilterSet):
+            concurrent_queries = True
+
+        qs = Book.objects.all()
+        expected = BookFilterSet(qs, QueryDict('')).render()
+        del threads[:]
+        fs = ConcurrentBookFilterSet(qs, QueryDict(''))
+        self.assertTrue(fs.can_run_concurrently())
+        self.assertEqual(fs.render(), expected)
+        self.assertEqual(len(threads), 3)
+        self.assertFalse(threading.current_thread() in threads)
+
+        # The pool is shared, and max_workers limits the threads used at once.
+        self.assertTrue(get_thread_pool() is get_thread_pool())
+        del threads[:]
+        ConcurrentBookFilterSet.max_workers = 1
+        self.assertEqual(ConcurrentBookFilterSet(qs, QueryDict('')).render(), expected)
+        self.assertEqual(len(set(threads)), 1)
+
 
 class TestFilters(TestCase):
     fixtures = ['django_easyfilters_tests']
@@ -239,6 +645,22 @@ class TestFilters(TestCase):
                 self.assertEqual(text_type(book.genre) if book.genre else '(null)', choice.label)
         self.assertTrue(reached)
 
+    def test_choice_params(self):
+        """
+        Tests that the params of choices share the other params of the filter,
+        and give the same query strings as a QueryDict.
+        """
+        qs = Book.objects.all()
+        params = QueryDict('binding=H&q=a+b%26c&page=2&genre=1&genre--isnull=')
+        filter1 = ForeignKeyFilter('genre', Book, params)
+        choices = filter1.get_choices(qs)
+        self.assertTrue(len(choices) > 1)
+        for choice in choices:
+            self.assertTrue(choice.params.shared is choices[0].params.shared)
+            self.assertFalse('page' in choice.params)
+            self.assertEqual(choice.params.getlist('binding'), ['H'])
+            self.assertEqual(choice.params, QueryDict(choice.params.urlencode()))
+
     def test_foreignkey_remove_link(self):
         """
         Ensure that a ForeignKey Filter will turn into a 'remove' link when an
@@ -408,7 +830,7 @@ class TestFilters(TestCase):
         # ...and excludes Jane Eyre
         self.assertFalse(qs_emily.filter(name='Jane Eyre').exists())
 
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             # 0 query for all chosen objects (already done)
             # 1 query for available objects
             # 1 query for counts
@@ -448,6 +870,63 @@ class TestFilters(TestCase):
                           (text_type(anne), FILTER_REMOVE),
                           (text_type(charlotte), FILTER_DISPLAY)])
 
+    def test_manytomany_filter_duplicate_rows(self):
+        """
+        Tests that rows repeated by a join in the base QuerySet are only
+        counted once.
+        """
+        qs = Book.objects.filter(authors__name__icontains='e')
+        pks = set(qs.values_list('pk', flat=True))
+        self.assertTrue(qs.count() > len(pks))
+        filter1 = ManyToManyFilter('authors', Book, MultiValueDict())
+        with self.assertNumQueries(2):
+            choices = filter1.get_choices(qs)
+            sql = connections[qs.db].queries[-1]['sql']
+        self.assertTrue(len(choices) > 0)
+        # The authors are looked up by the counted keys, without filtering
+        # the intermediate table by qs again.
+        self.assertNotIn(Book.authors.through._meta.db_table, sql)
+        for choice in choices:
+            author = Author.objects.get(pk=choice.params.getlist('authors')[-1])
+            self.assertEqual(choice.count,
+                             Book.objects.filter(pk__in=pks, authors=author).count())
+
+    def test_aliased_values_query_pk(self):
+        # 'pk' is resolved to the primary key field on all Django versions.
+        qs = Book.objects.filter(authors__name__icontains='e')
+        query, field = aliased_values_query(qs, 'pk')
+        self.assertEqual(field, Book._meta.pk)
+        self.assertEqual(sorted(row[0] for row in
+                                query.get_compiler(qs.db).results_iter()),
+                         sorted(qs.values_list('pk', flat=True)))
+
+    def test_manytomany_filter_self_referential(self):
+        joe = Person.objects.create(name="Joe", date_of_birth=date(2011, 1, 10))
+        peter = Person.objects.create(name="Peter", date_of_birth=date(2011, 1, 20))
+        mary = Person.objects.create(name="Mary", date_of_birth=date(2011, 2, 5))
+        joe.friends.add(peter, mary)
+        peter.friends.add(mary)
+
+        class PersonFilterSet(FilterSet):
+            fields = ['friends']
+            combine_queries = True
+
+        for params in [MultiValueDict(), MultiValueDict({'friends': [str(joe.pk)]})]:
+            f = ManyToManyFilter('friends', Person, params)
+            qs = f.apply_filter(Person.objects.all())
+            with self.assertNumQueries(2):
+                choices = [c for c in f.get_choices(qs) if c.link_type == FILTER_ADD]
+            chosen = [int(pk) for pk in params.getlist('friends')]
+            self.assertEqual(sorted(int(c.params.getlist('friends')[-1]) for c in choices),
+                             sorted(p.pk for p in [joe, peter, mary] if p.pk not in chosen))
+            for c in choices:
+                pk = int(c.params.getlist('friends')[-1])
+                self.assertEqual(c.count, qs.filter(friends=pk).count())
+
+            fs = PersonFilterSet(Person.objects.all(), params)
+            self.assertEqual([c.count for c in fs.get_filter_choices('friends')],
+                             [c.count for c in f.get_choices(qs)])
+
     def test_manytomany_filter_invalid_query(self):
         self.do_invalid_query_param(lambda params:
                                              ManyToManyFilter('authors', Book, params),
@@ -651,6 +1130,41 @@ class TestFilters(TestCase):
         self.do_invalid_query_param(lambda params: DateTimeFilter('date_published', Book, params, max_links=10),
                                          MultiValueDict({'date_published':['1818xx']}))
 
+    def test_date_choice(self):
+        """
+        Tests that DateChoice parses its values to dates once, in the same way
+        for params and for dates from the database.
+        """
+        choice = DateChoice.from_param('2010-05..2011-02')
+        self.assertEqual(choice.dates, (date(2010, 5, 1), date(2011, 2, 1)))
+        self.assertEqual(choice.display(), 'May-February')
+        self.assertEqual(choice.make_lookup('date_published'),
+                         {'date_published__gte': date(2010, 5, 1),
+                          'date_published__lt': date(2011, 3, 1)})
+
+        choice2 = DateChoice.from_datetime(MONTH, datetime(2010, 5, 17, 12, 30))
+        self.assertEqual(choice2, DateChoice.from_param('2010-05'))
+        self.assertEqual(choice2.dates, DateChoice.from_param('2010-05').dates)
+        # More specific choices are greater.
+        self.assertTrue(choice2 > choice)
+        self.assertTrue(DateChoice.from_param('2010') < choice)
+
+        # Choices can't be changed, so they are shared.
+        self.assertTrue(DateChoice.from_param('2010-05') is choice2)
+        self.assertEqual(len(set([choice, choice2, DateChoice.from_param('2010-05')])), 2)
+        self.assertRaises(AttributeError, setattr, choice, 'values', ('2012',))
+
+    def test_numeric_range_choice(self):
+        choice_type = NumericRangeFilter('price', Book, MultiValueDict()).choice_type
+        choice = choice_type.from_param('1.00..2.00i')
+        self.assertEqual(choice.values, (RangeEnd(Decimal('1.00'), False),
+                                         RangeEnd(Decimal('2.00'), True)))
+        self.assertTrue(choice_type.from_param('1.00..2.00i') is choice)
+        self.assertRaises(AttributeError, setattr, choice, 'values', ())
+        self.assertRaises(AttributeError, setattr, choice.values[0], 'inclusive', True)
+        # Equal values that show differently are not shared.
+        self.assertEqual(str(choice_type.from_param('1.0..2.00i')), '1.0..2.00i')
+
     def test_datetime_filter_empty_qs(self):
         """
         Tests that DateTimeFilter works when it is passed in an empty QuerySet.
@@ -663,6 +1177,61 @@ class TestFilters(TestCase):
         self.assertEqual(len(choices), 0)
         self.assertEqual(len(qs_filtered), 0)
 
+    def test_datetime_filter_histogram(self):
+        """
+        Tests that the 'histogram' option gives the same choices with a single
+        query.
+        """
+        qs = Book.objects.all()
+        params = MultiValueDict()
+
+        class BookFilterSet(FilterSet):
+            fields = [('date_published', {'histogram': 'day', 'max_links': 10})]
+            combine_queries = True
+
+        while True:
+            f1 = DateTimeFilter('date_published', Book, params, max_links=10)
+            f2 = DateTimeFilter('date_published', Book, params, max_links=10,
+                                histogram='day')
+            qs_filtered = f1.apply_filter(qs)
+            choices = [(c.label, c.count, c.link_type) for c in f1.get_choices(qs_filtered)]
+            with self.assertNumQueries(1 if f2.get_histogram_type() else 0):
+                self.assertEqual(choices,
+                                 [(c.label, c.count, c.link_type) for c in f2.get_choices(qs_filtered)])
+            fs = BookFilterSet(qs, params)
+            with self.assertNumQueries(1 if f2.get_histogram_type() else 0):
+                self.assertEqual(choices, [(c.label, c.count, c.link_type)
+                                           for c in fs.get_filter_choices('date_published')])
+            add = [c for c in f1.get_choices(qs_filtered)
+                   if c.link_type == FILTER_ADD and c.label != '(null)']
+            if not add:
+                break
+            params = add[0].params
+
+        # Histograms can be cached until the data changes.
+        date_histograms.clear()
+        for num_queries in [1, 0]:
+            f = DateTimeFilter('date_published', Book, MultiValueDict(),
+                               histogram='month', cache_histogram=True)
+            with self.assertNumQueries(num_queries):
+                choices = f.get_choices(qs)
+        Book.objects.get(name='Jane Eyre').save()
+        f = DateTimeFilter('date_published', Book, MultiValueDict(),
+                           histogram='month', cache_histogram=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(choices, f.get_choices(qs))
+
+        # Histograms with more than max_rows dates are not cached.
+        date_histograms.clear()
+        self.addCleanup(setattr, date_histograms, 'max_rows', date_histograms.max_rows)
+        date_histograms.max_rows = 2
+        for num_queries in [1, 1]:
+            f = DateTimeFilter('date_published', Book, MultiValueDict(),
+                               histogram='month', cache_histogram=True)
+            with self.assertNumQueries(num_queries):
+                self.assertEqual(choices, f.get_choices(qs))
+            self.assertTrue(len(f.get_histogram(qs, MONTH)[0]) > 2)
+
     def test_datetime_filter_remove_broad(self):
         """
         If we remove a broader choice (e.g. year), the more specific choices
@@ -838,20 +1407,83 @@ class TestFilters(TestCase):
 
         # Should only take 2 queries - one to find out how many distinct values,
         # one to get the counts.
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             choices = filter1.get_choices(qs)
 
         self.assertEqual(len(choices), 1)
         self.assertTrue('3.5' in choices[0].label)
 
+        # Without counts, the values found by the first query are used.
+        filter2 = NumericRangeFilter('rating', Book, MultiValueDict(), max_links=20,
+                                     show_counts=False)
+        qs = Book.objects.all()
+        with self.assertNumQueries(1):
+            choices = filter2.get_choices(qs)
+        self.assertEqual([c.label for c in choices],
+                         [c.label for c in NumericRangeFilter('rating', Book, MultiValueDict(),
+                                                              max_links=20).get_choices(qs)])
+        self.assertEqual(choices[0].label, '(null)')
+
+    def test_null_counts(self):
+        # NULLs are counted by the same query as the other values.
+        qs = Book.objects.all()
+        null_ratings = qs.filter(rating=None).count()
+        null_genres = qs.filter(genre=None).count()
+        self.assertTrue(null_ratings > 0)
+        self.assertTrue(null_genres > 0)
+
+        filter1 = NumericRangeFilter('rating', Book, MultiValueDict(), max_links=2)
+        with self.assertNumQueries(2):
+            choices = filter1.get_choices(qs)
+        self.assertEqual(choices[0].label, '(null)')
+        self.assertEqual(choices[0].count, null_ratings)
+        self.assertEqual(sum(c.count for c in choices), qs.count())
+
+        filter1 = NumericRangeFilter('rating', Book, MultiValueDict(), max_links=2,
+                                     show_counts=False)
+        with self.assertNumQueries(1):
+            # NULLs are found by the same query as the range
+            choices = filter1.get_choices(qs)
+        self.assertEqual(choices[0].label, '(null)')
+
+        filter2 = ForeignKeyFilter('genre', Book, MultiValueDict())
+        with self.assertNumQueries(2):
+            # 1 query for counts, 1 for the genres
+            choices = filter2.get_choices(qs)
+        self.assertEqual(choices[0].label, '(null)')
+        self.assertEqual(choices[0].count, null_genres)
+
+    def test_foreignkey_label_fields(self):
+        qs = Book.objects.all()
+        filter1 = ForeignKeyFilter('genre', Book, MultiValueDict())
+        filter2 = ForeignKeyFilter('genre', Book, MultiValueDict(), label_fields=('name',))
+        choices1 = filter1.get_choices(qs)
+        with self.assertNumQueries(1):
+            # Counts and labels from the same query
+            choices2 = filter2.get_choices(qs)
+        self.assertEqual(choices1, choices2)
+
+        filter3 = ForeignKeyFilter('genre', Book, MultiValueDict(), label_fields=('name', 'likes'),
+                                   label_func=lambda values: '%(name)s (%(likes)s likes)' % values)
+        genre = Genre.objects.get(pk=6)
+        self.assertTrue('%s (%s likes)' % (genre.name, genre.likes) in
+                        [c.label for c in filter3.get_choices(qs)])
+
+    def test_filter_in_chunks(self):
+        pks = list(Book.objects.values_list('pk', flat=True))
+        self.assertTrue(len(pks) > 4)
+        with self.assertNumQueries((len(pks) + 3) // 4):
+            books = filter_in_chunks(Book.objects.all(), 'pk', pks, chunk_size=4)
+        self.assertEqual(sorted(b.pk for b in books), sorted(pks))
+
     def test_numericrange_filter_range_choices(self):
         # If data is more than max_links, we should get a range
         filter1 = NumericRangeFilter('price', Book, MultiValueDict(), max_links=8)
 
         qs = Book.objects.all()
-        # Should take 3 queries - one to find out how many distinct values,
-        # one to find a range, one to get the counts.
-        with self.assertNumQueries(4):
+        # Should take 2 queries - one to find out if there are more than
+        # max_links distinct values and the range, one to get the counts.
+        with self.assertNumQueries(2):
             choices = filter1.get_choices(qs)
 
         self.assertTrue(len(choices) <= 8)
@@ -871,6 +1503,201 @@ class TestFilters(TestCase):
         self.assertTrue('i' not in p1.split('..')[0])
         self.assertTrue('i' in p1.split('..')[1])
 
+    def test_numeric_range_counts(self):
+        """
+        Tests that uniform, sorted and unsorted ranges, which use different SQL,
+        count values on the bounds in the same way.
+        """
+        def expected(values, ranges):
+            counts = {}
+            for v in values:
+                if v is None:
+                    key = None
+                else:
+                    key = ranges[-1]
+                    for i, r in enumerate(ranges):
+                        if r[0] < v <= r[1] or (i == 0 and v == r[0]):
+                            key = r
+                            break
+                counts[key] = counts.get(key, 0) + 1
+            return counts
+
+        qs = Book.objects.all()
+        for field, uniform in [('rating', [(float(Decimal('0.1') * i), float(Decimal('0.1') * (i + 1)))
+                                           for i in range(10, 45)]),
+                               ('price', [(Decimal('0.5') * i, Decimal('0.5') * (i + 1))
+                                          for i in range(2, 20)])]:
+            self.assertTrue(uniform_step(uniform) is not None)
+            sorted_ranges = uniform[:-2] + [(uniform[-2][0], uniform[-1][1])]
+            self.assertTrue(uniform_step(sorted_ranges) is None)
+            values = list(qs.values_list(field, flat=True))
+            for ranges in [uniform, sorted_ranges, list(reversed(uniform))]:
+                self.assertEqual(dict(numeric_range_counts(qs, field, ranges)),
+                                 expected(values, ranges))
+
+        # Bounds of mixed types aren't bucketed with a step of the type of the
+        # first one.
+        mixed_ranges = [(0, 1.5), (1.5, 3.0), (3.0, 4.5), (4.5, 6.0)]
+        self.assertTrue(uniform_step(mixed_ranges) is None)
+        self.assertEqual(dict(numeric_range_counts(qs, 'rating', mixed_ranges)),
+                         expected(list(qs.values_list('rating', flat=True)), mixed_ranges))
+
+        # Integral values with an integral step must not use integer division.
+        edition_ranges = [(2 * i, 2 * (i + 1)) for i in range(5)]
+        self.assertEqual(dict(numeric_range_counts(qs, 'edition', edition_ranges)),
+                         expected(list(qs.values_list('edition', flat=True)), edition_ranges))
+        books = list(qs[:3])
+        for book, price in zip(books, [15, 25, 35]):
+            book.price = Decimal(price)
+            book.save()
+        price_ranges = [(Decimal(10 * i), Decimal(10 * (i + 1))) for i in range(1, 4)]
+        self.assertEqual(dict(numeric_range_counts(qs.filter(pk__in=[b.pk for b in books]),
+                                                   'price', price_ranges)),
+                         dict((r, 1) for r in price_ranges))
+
+    def test_numericrange_filter_quantile(self):
+        qs = Book.objects.all()
+        values = sorted(qs.exclude(price__isnull=True).values_list('price', flat=True))
+        # Same results from the database and from Python
+        self.assertEqual(quantile_bounds(qs, 'price', 4), ntile_bounds(values, 4))
+        self.assertEqual(ntile_bounds(list(range(1, 11)), 3), [(1, 4), (5, 7), (8, 10)])
+        # NTILE is only used with MySQL 8+ or MariaDB 10.2+
+        self.assertEqual([mysql_has_window_functions(v) for v in
+                          ['5.7.31', '8.0.21', '10.1.44-MariaDB', '5.5.5-10.1.44-MariaDB',
+                           '10.2.3-MariaDB-log', '5.5.5-10.3.8-MariaDB']],
+                         [False, True, False, False, True, True])
+
+        range_boundaries.clear()
+        filter1 = NumericRangeFilter('price', Book, MultiValueDict(), max_links=4,
+                                     range_strategy='quantile')
+        with self.assertNumQueries(3):
+            choices = filter1.get_choices(qs)
+        self.assertTrue(1 < len(choices) <= 4)
+        self.assertEqual(sum(c.count for c in choices), qs.count())
+        self.assertTrue(max(c.count for c in choices) < len(values) // 2)
+
+        # Boundaries are cached
+        with self.assertNumQueries(2):
+            self.assertEqual(choices, filter1.get_choices(qs))
+
+    def test_numericrange_filter_histogram(self):
+        """
+        Tests that the 'histogram_bins' option gives the same choices, with
+        drilldowns answered from the cached histogram.
+        """
+        qs = Book.objects.all()
+        numeric_histograms.clear()
+
+        def choices(f):
+            # Compare single values as numbers, since SQLite can drop the
+            # trailing zeros of decimals in counts.
+            def label(c):
+                try:
+                    return Decimal(c.label)
+                except InvalidOperation:
+                    return c.label
+            return [(label(c), c.count, c.link_type)
+                    for c in f.get_choices(f.apply_filter(qs))]
+
+        # Min/Max and the histogram, which has bins of 0.01 (the precision of
+        # prices), so all drilldowns can be answered from it.
+        num_queries = 2
+        to_visit = [MultiValueDict()]
+        while to_visit:
+            params = to_visit.pop()
+            f1 = NumericRangeFilter('price', Book, params)
+            expected = choices(f1)
+            for show_counts in [True, False]:
+                f2 = NumericRangeFilter('price', Book, params, histogram_bins=5000,
+                                        show_counts=show_counts)
+                with self.assertNumQueries(num_queries):
+                    result = choices(f2)
+                num_queries = 0
+                if show_counts:
+                    self.assertEqual(expected, result)
+            to_visit.extend(c.params for c in f1.get_choices(f1.apply_filter(qs))
+                            if c.link_type == FILTER_ADD and '-' in c.label)
+
+        # Bins wider than 1 on integral values
+        books = list(qs[:3])
+        for book, price in zip(books, [15, 25, 35]):
+            book.price = Decimal(price)
+            book.save()
+        qs_integral = qs.filter(pk__in=[b.pk for b in books])
+        grid = histogram_grid(Decimal(15), Decimal(35), 5)
+        self.assertEqual(grid[0], (Decimal(10), Decimal(20)))
+        self.assertEqual([row[:2] for row in numeric_histogram(qs_integral, 'price', grid)],
+                         [(0, 1), (1, 1), (2, 1)])
+        f1 = NumericRangeFilter('price', Book, MultiValueDict(), max_links=2)
+        f2 = NumericRangeFilter('price', Book, MultiValueDict(), max_links=2,
+                                histogram_bins=5)
+        with self.assertNumQueries(2):
+            choices2 = f2.get_choices(qs_integral)
+        self.assertEqual(f1.get_choices(qs_integral), choices2)
+
+        # Not when another filter narrows the QuerySet down afterwards
+        class BookFilterSet(FilterSet):
+            fields = [('price', {'histogram_bins': 5000}), 'binding']
+
+        class PlainBookFilterSet(FilterSet):
+            fields = ['price', 'binding']
+
+        params = MultiValueDict({'price': ['0i..10i'], 'binding': ['H']})
+        self.assertEqual(BookFilterSet(qs, params).get_filter_choices('price'),
+                         PlainBookFilterSet(qs, params).get_filter_choices('price'))
+
+        # Bins that are too coarse need queries
+        f = NumericRangeFilter('price', Book, MultiValueDict(), histogram_bins=1)
+        expected = choices(NumericRangeFilter('price', Book, MultiValueDict()))
+        with self.assertNumQueries(4):
+            self.assertEqual(expected, choices(f))
+
+    def test_range_filters_cache_bounds(self):
+        """
+        Tests that the 'cache_bounds' option skips the Min/Max aggregate, until
+        the bounds have been stale for longer than allowed.
+        """
+        qs = Book.objects.all()
+        field_bounds.clear()
+
+        def choices(f):
+            return [(c.label, c.count, c.link_type) for c in f.get_choices(qs)]
+
+        # NumericRangeFilter finds the bounds in the same statement as its
+        # probe for distinct values, so the cache saves a scan but no query.
+        for cls, field, queries in [(NumericRangeFilter, 'price', [2, 2]),
+                                    (DateTimeFilter, 'date_published', [2, 1])]:
+            expected = choices(cls(field, Book, MultiValueDict()))
+            for num_queries in queries:
+                f = cls(field, Book, MultiValueDict(), cache_bounds=60)
+                with self.assertNumQueries(num_queries):
+                    self.assertEqual(expected, choices(f))
+            self.assertNotEqual(f.get_cached_bounds(qs), None)
+
+            Book.objects.get(name='Jane Eyre').save()
+            f = cls(field, Book, MultiValueDict(), cache_bounds=60)
+            self.assertNotEqual(f.get_cached_bounds(qs), None)
+            with self.assertNumQueries(queries[1]):
+                choices(f)
+            f = cls(field, Book, MultiValueDict(), cache_bounds=0)
+            self.assertEqual(f.get_cached_bounds(qs), None)
+            with self.assertNumQueries(queries[0]):
+                choices(f)
+            f = cls(field, Book, MultiValueDict(), cache_bounds=0)
+            self.assertNotEqual(f.get_cached_bounds(qs), None)
+            with self.assertNumQueries(queries[1]):
+                choices(f)
+
+        # Values above stale bounds are added to the count of the last range.
+        field_bounds.clear()
+        choices(NumericRangeFilter('price', Book, MultiValueDict(), cache_bounds=60))
+        book = Book.objects.exclude(price=None)[0]
+        book.price = Decimal('999.00')
+        book.save()
+        f = NumericRangeFilter('price', Book, MultiValueDict(), cache_bounds=60)
+        self.assertNotEqual(f.get_cached_bounds(qs), None)
+        self.assertEqual(sum(c.count for c in f.get_choices(qs)), qs.count())
+
     def test_numericrange_filter_apply_filter(self):
         qs = Book.objects.all()
 
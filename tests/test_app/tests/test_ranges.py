@@ -1,7 +1,7 @@
 from decimal import Decimal
 import unittest
 
-from django_easyfilters.ranges import auto_ranges
+from django_easyfilters.ranges import auto_ranges, quantile_ranges, histogram_grid
 
 
 class TestRanges(unittest.TestCase):
@@ -82,3 +82,41 @@ class TestRanges(unittest.TestCase):
 
         r2 = auto_ranges(Decimal('1'), Decimal('10'), 10)
         self.assertEqual(type(r2[0][0]), Decimal)
+
+    def test_quantile_ranges(self):
+        """
+        quantile_ranges should round boundaries to significant digits, and
+        merge groups that become empty.
+        """
+        r = quantile_ranges([(Decimal('0.49'), Decimal('1.234')),
+                             (Decimal('1.24'), Decimal('1.26')),
+                             (Decimal('1.3'), Decimal('17.45')),
+                             (Decimal('18'), Decimal('1234.5'))])
+        self.assertEqual(r,
+                         [(Decimal('0.49'), Decimal('1.2')),
+                          (Decimal('1.2'), Decimal('1.3')),
+                          (Decimal('1.3'), Decimal('17')),
+                          (Decimal('17'), Decimal('1300'))])
+        self.assertEqual(str(r[-1][1]), '1300')
+
+        r2 = quantile_ranges([(1, 10), (10, 10), (10, 2345)])
+        self.assertEqual(r2, [(1, 10), (10, 2400)])
+        self.assertEqual(type(r2[0][0]), int)
+
+        self.assertEqual(quantile_ranges([(0.5, 0.5)]), [(0.5, 0.5)])
+
+    def test_histogram_grid(self):
+        """
+        histogram_grid should use a power of ten as the width of the bins.
+        """
+        r = histogram_grid(Decimal('3.25'), Decimal('47.5'), 100)
+        self.assertEqual(r[0], (Decimal('3'), Decimal('4')))
+        self.assertEqual(r[-1], (Decimal('47'), Decimal('48')))
+        self.assertEqual(len(r), 45)
+
+        r2 = histogram_grid(Decimal('3.25'), Decimal('47.5'), 1000)
+        self.assertEqual(r2[0], (Decimal('3.2'), Decimal('3.3')))
+        self.assertEqual(len(r2), 443)
+
+        self.assertEqual(histogram_grid(3, 5, 1000), [(3, 4), (4, 5)])
+        self.assertEqual(histogram_grid(7, 7, 1000), [(7, 8)])
@@ -2,6 +2,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'tests.db',
+        # A file, rather than an in-memory database, so that connections of
+        # other threads can see the data (see TestConcurrentQueries).
+        'TEST_NAME': 'tests_test.db',
+        'TEST': {'NAME': 'tests_test.db'},
     },
 }
 